@@ -2,18 +2,22 @@ import streamlit as st
 from streamlit_drawable_canvas import st_canvas
 from PIL import Image, ImageDraw
 import requests
-import json
 import websocket
-import time
 import uuid
-import io
+import logging
 import os
 import numpy as np
-from pass_websocket import run_pass, upload_image
-from segment_anything import segment_image, overlay_mask_on_image
-from sam_runner import sam2_predict
+import image_codec
+import tracing
+from image_store import ImageStore
+from render_jobs import get_job, pop_job, submit_render, submit_variations
+from workflow_template import WorkflowError, get_template
+from hires_segmentation import segment_selection
+from mask_polygons import mask_to_fabric, path_to_polygon
+from mask_raster import SelectionGeometry, build_render_mask, pack_mask
 import cv2
-from io import BytesIO
+
+logger = logging.getLogger(__name__)
 
 
 @st.fragment
@@ -39,10 +43,12 @@ def make_canvas():
             for obj in editable.json_data["objects"]:
                 if obj["type"] == "path" and not "final" in obj:
                     poly = path_to_polygon(obj)
+                    if point_label == 0:
+                        poly.update(op="subtract", fill=SUBTRACT_FILL, stroke=SUBTRACT_STROKE)
                     fabric_objects.append(poly)
                     dirty = True
 
-    # Button to run SAM segmentation
+    # Magic Wand: refine the active selection with the newly clicked points
     if canvas_editor == "Magic Wand":
         user_points = []
         if editable.json_data:
@@ -54,113 +60,164 @@ def make_canvas():
                     x_orig = int(round(x_disp * (active_w / disp_w)))
                     y_orig = int(round(y_disp * (active_h / disp_h)))
                     user_points.append([x_orig, y_orig])
-        with st.spinner("Running SAM segmentation..."):
-            try:
-                user_points_labels = np.full(len(user_points), 1)
-                start_time = time.time()
-                masks = sam2_predict(
-                    st.session_state.active_image, user_points, user_points_labels
-                )
-                end_time = time.time()
-                print(f"Sam2.1 took {end_time - start_time}")
-                flat_masks = flatten_masks(masks)
-
-                # Build polygons from masks
-                fabric_objects = st.session_state.sam_polygons["objects"]
-                for mask in flat_masks:
-                    mask_u8 = (mask * 255).astype("uint8")
-                    cnts, _ = cv2.findContours(
-                        mask_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-                    )
-                    for cnt in cnts:
-                        if cv2.contourArea(cnt) < 20:
-                            continue
-                        cnt = cnt.squeeze()
-                        xs, ys = cnt[:, 0], cnt[:, 1]
-                        xs_disp = xs * disp_w / active_w
-                        ys_disp = ys * disp_h / active_h
-
-                        left, top = int(xs_disp.min()), int(ys_disp.min())
-                        points = [
-                            {"x": int(xd - left), "y": int(yd - top)}
-                            for xd, yd in zip(xs_disp, ys_disp)
+        if user_points:
+            with st.spinner("Running SAM segmentation..."):
+                try:
+                    selection = target_selection(user_points)
+                    user_points_labels = np.full(len(user_points), point_label)
+                    with tracing.trace("segment", points=len(user_points)):
+                        mask, score = segment_selection(
+                            st.session_state.active_image,
+                            selection,
+                            user_points,
+                            user_points_labels,
+                        )
+                        selection["points"] += user_points
+                        selection["labels"] += user_points_labels.tolist()
+                        selection["mask"] = pack_mask(mask)
+
+                        # Replace only this selection's polygons
+                        fabric_objects = [
+                            obj
+                            for obj in st.session_state.sam_polygons["objects"]
+                            if obj.get("selection") != selection["id"]
                         ]
-
-                        fabric_objects.append(
-                            {
-                                "type": "polygon",
-                                "version": "5.2.4",
-                                "originX": "left",
-                                "originY": "top",
-                                "left": left,
-                                "top": top,
-                                "width": int(xs_disp.max() - xs_disp.min()),
-                                "height": int(ys_disp.max() - ys_disp.min()),
-                                "fill": "rgba(255,255,6,0.6)",
-                                "stroke": "rgba(255,255,6,1.0)",
-                                "strokeWidth": 2,
-                                "points": points,
-                            }
+                        polygons, stats = mask_to_fabric(
+                            mask,
+                            disp_w / active_w,
+                            disp_h / active_h,
+                            selection=selection["id"],
                         )
-                        dirty = True
+                        tracing.annotate(
+                            selection=selection["id"],
+                            contours=stats["contours"],
+                            vertices_in=stats["vertices_in"],
+                            vertices_out=stats["vertices_out"],
+                        )
+                    fabric_objects += polygons
 
-                st.session_state.sam_polygons = {
-                    "objects": fabric_objects,
-                    "background": "",
-                }
-                editable.json_data["objects"] = fabric_objects
+                    st.session_state.sam_polygons = {
+                        "objects": fabric_objects,
+                        "background": "",
+                    }
+                    editable.json_data["objects"] = fabric_objects
 
-            except Exception as e:
-                st.warning(f"SAM segmentation failed: {e}")
-        # Store mask data for rendering
+                except Exception as e:
+                    st.warning(f"SAM segmentation failed: {e}")
+            # The clicked points are consumed either way; redraw without them.
+            dirty = True
 
     if dirty:
         dirty = False
         st.session_state.canvas_key_counter += 1
         st.rerun()
-    if editable.image_data is not None:
-        st.session_state.sam_mask_data = editable.image_data.copy()
-
-
-def path_to_polygon(path):
-    # ratio_scale = [disp_w / orig_w, disp_h / orig_h]
-    ratio_scale = [1, 1]
-    return {
-        "type": "polygon",
-        "version": "5.2.4",
-        "originX": "center",
-        "originY": "center",
-        "left": path["left"] * ratio_scale[0],
-        "top": path["top"] * ratio_scale[1],
-        "width": path["width"] * ratio_scale[0],
-        "height": path["height"] * ratio_scale[1],
-        "fill": "rgba(255,255,6,0.6)",
-        "stroke": "rgba(255,255,6,1.0)",
-        "strokeWidth": 2,
-        "points": [
-            {"x": point[1] * ratio_scale[0], "y": point[2] * ratio_scale[1]}
-            for point in path["path"]
-        ],
-    }
-
-
-def flatten_masks(masks):
-    """Recursively flatten all masks to a list of 2D numpy arrays."""
-    flat = []
-    if isinstance(masks, (list, tuple)):
-        for m in masks:
-            flat.extend(flatten_masks(m))
-    elif hasattr(masks, "cpu") and hasattr(masks, "numpy"):
-        arr = masks.cpu().numpy()
-        while arr.ndim > 2:
-            arr = arr[0]
-        flat.append(arr)
-    elif isinstance(masks, np.ndarray):
-        arr = masks
-        while arr.ndim > 2:
-            arr = arr[0]
-        flat.append(arr)
-    return flat
+
+
+def target_selection(points):
+    """
+    Return the Magic Wand selection new clicks refine: the selection hit by
+    the first click if any, else the open one, starting one if needed.
+    """
+    selections = st.session_state.sam_selections
+    geometry = SelectionGeometry(
+        st.session_state.sam_polygons["objects"], active_w / disp_w, active_h / disp_h
+    )
+    for obj in geometry.hit_test(*points[0]):
+        if obj.get("selection") is not None:
+            return selections[obj["selection"]]
+    if not selections or selections[-1].get("closed"):
+        selections.append(
+            {
+                "id": len(selections),
+                "points": [],
+                "labels": [],
+                "logits": None,
+                "crop_box": None,
+                "crop_logits": None,
+            }
+        )
+    return selections[-1]
+
+
+def reset_selections():
+    st.session_state.sam_polygons = {"objects": [], "background": ""}
+    st.session_state.sam_selections = []
+
+
+@st.fragment(run_every=1.0)
+def render_status():
+    """Poll the session's render job: progress and previews, then apply the result."""
+    job_id = st.session_state.render_job
+    if job_id is None:
+        return
+    job = get_job(job_id)
+    if job is None:
+        st.session_state.render_job = None
+        return
+    if not job.finished:
+        value, maximum = job.progress
+        if job.status == "queued":
+            text = "Waiting for the render server..."
+        elif maximum:
+            text = f"Rendering... step {value}/{maximum}"
+        else:
+            text = "Rendering..."
+        st.progress(value / maximum if maximum else 0.0, text=text)
+        if job.preview is not None:
+            st.image(job.preview, caption="Preview", use_container_width=True)
+        return
+
+    pop_job(job_id)
+    st.session_state.render_job = None
+    if job.status == "failed":
+        st.error(f"Render failed: {job.error}")
+        return
+    logger.info(
+        "Render %s complete in %.1fs (%d nodes executed, %d cached)",
+        job.id, job.finished_at - job.submitted_at, job.executed, job.cached,
+    )
+    if isinstance(job.result, list):
+        # Variations: the user picks the new image from the gallery
+        st.session_state.variations = job.result
+        st.rerun()
+    apply_render(job.result)
+
+
+def apply_render(image):
+    st.session_state.image_store.push(image)
+    show_current_image()
+
+
+def step_history(step):
+    store = st.session_state.image_store
+    moved = store.undo() if step < 0 else store.redo()
+    if moved:
+        show_current_image()
+
+
+def show_current_image():
+    st.session_state.active_image = st.session_state.image_store.current()
+    st.session_state.variations = None
+    # Selections were drawn on the previous image
+    reset_selections()
+    st.session_state.canvas_key_counter += 1
+    st.rerun()
+
+
+def variation_gallery():
+    variations = st.session_state.variations
+    if not variations:
+        return
+    st.markdown("Pick a variation:")
+    cols = st.columns(2)
+    for i, image in enumerate(variations):
+        with cols[i % 2]:
+            st.image(image_codec.encode(image, "jpeg"), use_container_width=True)
+            if st.button(f"Use #{i + 1}", key=f"use_variation_{i}", use_container_width=True):
+                apply_render(image)
+    if st.button("Discard variations", use_container_width=True):
+        st.session_state.variations = None
+        st.rerun()
 
 
 def draw_mask_polygons_on_image(image, mask_np, color=(246, 250, 6), alpha=0.5):
@@ -214,9 +271,16 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+tracing.start_exporters()
+
 CLIENT_ID = str(uuid.uuid4())
+SUBTRACT_FILL = "rgba(234,67,53,0.5)"
+SUBTRACT_STROKE = "rgba(234,67,53,1.0)"
 MAX_CANVAS_WIDTH = 800
 
+if "image_store" not in st.session_state:
+    st.session_state.image_store = ImageStore()
+# The decoded current and original images, owned by image_store
 if "active_image" not in st.session_state:
     st.session_state.active_image = None
 if "original_image" not in st.session_state:
@@ -227,20 +291,31 @@ if "canvas_key_counter" not in st.session_state:
     st.session_state.canvas_key_counter = 0
 if "sam_polygons" not in st.session_state:
     st.session_state.sam_polygons = {"objects": [], "background": ""}
+if "sam_selections" not in st.session_state:
+    st.session_state.sam_selections = []
+if "render_job" not in st.session_state:
+    st.session_state.render_job = None
+if "variations" not in st.session_state:
+    st.session_state.variations = None
 
 
 def handle_file_upload():
+    store = st.session_state.image_store
     if st.session_state.file_uploader is not None:
         uploaded_file = st.session_state.file_uploader
-        st.session_state.active_image = Image.open(uploaded_file).convert("RGB")
+        with tracing.span("upload.decode"):
+            image = Image.open(uploaded_file).convert("RGB")
+        store.reset(image)
+        st.session_state.active_image = store.current()
         st.session_state.original_dims = st.session_state.active_image.size
         # When a new image is uploaded, clear the old polygons
-        st.session_state.sam_polygons = {"objects": [], "background": ""}
+        reset_selections()
         st.session_state.canvas_key_counter += 1
     else:
+        store.reset(None)
         st.session_state.active_image = None
         st.session_state.original_dims = None
-    st.session_state.original_image = st.session_state.active_image.copy()
+    st.session_state.original_image = store.original()
 
 
 st.title("🌍🎨 Earth Canvas")
@@ -248,24 +323,28 @@ st.markdown(
     """:grey[*Transform your generated designs into photorealistic renders in three simple steps!*]"""
 )
 
+RENDER_WORKFLOW = "BuildingEditFast.json"
 try:
-    with open("workflow_api.json", "r") as f:
-        WORKFLOW_TEMPLATE = json.load(f)
-except:
-    st.error("`workflow_api.json` not found! Please create it.")
+    missing_slots = [
+        slot
+        for slot in ("prompt", "source_image", "mask_image", "original_image", "seed")
+        if not get_template(RENDER_WORKFLOW).has_slot(slot)
+    ]
+    if missing_slots:
+        raise WorkflowError(f"no node for {', '.join(missing_slots)}")
+except (OSError, WorkflowError) as e:
+    st.error(f"`{RENDER_WORKFLOW}` could not be loaded: {e}")
     st.stop()
 
 
 def convert_for_download(image):
+    # Encoded once per image; reruns reuse the cached bytes
     try:
         if image is None:
             st.warning("No image available to download.")
             return
 
-        buf = BytesIO()
-        image.save(buf, format="JPEG")
-        byte_im = buf.getvalue()
-        return byte_im
+        return image_codec.encode(image, "jpeg")
     except Exception as e:
         st.error(f"An error occurred during download: {e}")
 
@@ -289,7 +368,7 @@ with import_col:
         )
     if st.session_state.active_image:
         st.image(
-            st.session_state.original_image,
+            image_codec.encode(st.session_state.original_image, "jpeg"),
             caption="Input image",
             use_container_width=True,
         )
@@ -301,6 +380,18 @@ with editor_col:
             horizontal=True,
             key="polygon_edit_mode",
         )
+        mode_col, new_col = st.columns([3, 1])
+        point_mode = mode_col.radio(
+            label="Selection mode:",
+            options=("Add to selection", "Remove from selection"),
+            horizontal=True,
+            key="selection_point_mode",
+        )
+        point_label = 1 if point_mode == "Add to selection" else 0
+        if canvas_editor == "Magic Wand":
+            if new_col.button("New selection", use_container_width=True):
+                if st.session_state.sam_selections:
+                    st.session_state.sam_selections[-1]["closed"] = True
 with controls_col:
     with st.container(border=True):
         prompt_text = st.text_area(
@@ -308,17 +399,42 @@ with controls_col:
             placeholder="Aerial view of office buildings in a (neoclassical architectural style), cinematic lighting, 4k, ultra-detailed.",
             height=125,
         )
+        seed = st.number_input(
+            "Seed",
+            min_value=-1,
+            value=1,
+            step=1,
+            help="Same seed, selection and prompt give the same render, served from cache. -1 picks a random seed.",
+        )
+        with st.expander("Variations"):
+            seeds_per_prompt = st.number_input(
+                "Seeds per prompt",
+                min_value=1,
+                max_value=8,
+                value=1,
+                help="Renders consecutive seeds starting from Seed.",
+            )
+            extra_prompts = st.text_area(
+                "Other prompts, one per line:",
+                height=100,
+            )
 
         c1, c2 = st.columns(2)
         render_button = c1.button(
             "Render Design", use_container_width=True, type="primary"
         )
         if c2.button("Clear Polygons", use_container_width=True):
-            st.session_state.sam_polygons = {"objects": [], "background": ""}
+            reset_selections()
             st.session_state.canvas_key_counter += 1
             st.rerun()
-
-        byte_im = convert_for_download(st.session_state.original_image)
+        store = st.session_state.image_store
+        u1, u2 = st.columns(2)
+        if u1.button("Undo Render", use_container_width=True, disabled=not store.can_undo):
+            step_history(-1)
+        if u2.button("Redo Render", use_container_width=True, disabled=not store.can_redo):
+            step_history(1)
+
+        byte_im = convert_for_download(st.session_state.active_image)
         if byte_im:
             download_button = st.download_button(
                 label="Download Image",
@@ -349,89 +465,53 @@ if st.session_state.active_image:
 
     with controls_col:
         if render_button:
-            # if editable.image_data is not None:
-            #    st.session_state.sam_mask_data = editable.image_data.copy()
-            # Retrieve alpha channel from the SAM-editable canvas
-            sam_alpha = None
-            if (
-                "sam_mask_data" in st.session_state
-                and st.session_state.sam_mask_data is not None
-            ):
-                #                sam_alpha = editable.image_data.copy()[:, :, 3]
-                st.image(st.session_state.sam_mask_data)
-                sam_alpha = st.session_state.sam_mask_data[:, :, 3]
-                sam_alpha = np.where(sam_alpha > 0, 255, 0).astype(np.uint8)
+            # Build the mask at source resolution from the selection geometry
+            selection_masks = {
+                s["id"]: s["mask"]
+                for s in st.session_state.sam_selections
+                if s.get("mask") is not None
+            }
+            render_mask = build_render_mask(
+                st.session_state.sam_polygons["objects"],
+                selection_masks,
+                st.session_state.active_image.size,
+                (disp_w, disp_h),
+            )
 
             # Check if we have a mask to render
-            has_mask = sam_alpha is not None and np.sum(sam_alpha) > 0
+            has_mask = bool(render_mask.any())
 
             if not has_mask:
                 st.warning(
                     "Add points and run SAM segmentation to create a mask for rendering."
                 )
+            elif st.session_state.render_job is not None:
+                st.info("A render is already in progress.")
             else:
-                with st.spinner("Processing your request... This may take a moment."):
-                    combined_alpha = sam_alpha
-                    mask_pil = Image.fromarray(combined_alpha)
-                    original_mask = mask_pil.resize(
-                        st.session_state.active_image.size, Image.LANCZOS
-                    )
-                    mask_bytes = io.BytesIO()
-                    original_mask.save(mask_bytes, format="PNG")
-                    mask_bytes.seek(0)
-
-                    original_image_bytes = io.BytesIO()
-                    st.session_state.original_image.save(
-                        original_image_bytes, format="PNG"
-                    )
-                    original_image_bytes.seek(0)
-
-                    source_image_bytes = io.BytesIO()
-                    st.session_state.active_image.save(source_image_bytes, format="PNG")
-                    source_image_bytes.seek(0)
-
-                    # mask_bytes = io.BytesIO(); original_mask.save(mask_bytes, format="PNG"); mask_bytes.seek(0)
-
-                    original_path = upload_image(
-                        original_image_bytes, f"original_{CLIENT_ID}.png"
-                    )
-                    source_path = upload_image(
-                        source_image_bytes, f"source_{CLIENT_ID}.png"
-                    )
-                    mask_path = upload_image(
-                        mask_bytes, f"mask_{CLIENT_ID}.png", image_type="mask"
-                    )
-
-                    images = run_pass(
+                prompts = [prompt_text] + [
+                    line.strip() for line in extra_prompts.splitlines() if line.strip()
+                ]
+                seeds = [
+                    int(seed) + i if seed >= 0 else -1 for i in range(int(seeds_per_prompt))
+                ]
+                variants = [(p, s) for p in prompts for s in seeds]
+                if len(variants) == 1:
+                    st.session_state.render_job = submit_render(
                         prompt_text,
-                        os.path.abspath(source_path),
-                        os.path.abspath(mask_path),
-                        os.path.abspath(original_path),
-                        os.path.abspath("BuildingEditFast.json"),
+                        st.session_state.active_image,
+                        render_mask,
+                        st.session_state.original_image,
+                        os.path.abspath(RENDER_WORKFLOW),
+                        int(seed),
                     )
-
-                    final_image = None
-                    if images:
-                        for node_id in images:
-                            for image_data in images[node_id]:
-                                final_image = Image.open(io.BytesIO(image_data))
-                                break
-                            if final_image:
-                                break
-
-                    if final_image:
-                        print("Enhance complete")
-                        st.success("Enhancement complete!")
-                        st.session_state.active_image = final_image
-                        # st.session_state.original_dims = final_image.size
-                        active_w, active_h = st.session_state.active_image.size
-                        print("Set final image")
-                        # Clear the polygons after successful render
-                        st.session_state.sam_polygons = {
-                            "objects": [],
-                            "background": "",
-                        }
-                        st.session_state.canvas_key_counter += 1
-                        st.rerun()
-                    else:
-                        st.error("Render process failed to return an image.")
+                else:
+                    st.session_state.variations = None
+                    st.session_state.render_job = submit_variations(
+                        variants,
+                        st.session_state.active_image,
+                        render_mask,
+                        st.session_state.original_image,
+                        os.path.abspath(RENDER_WORKFLOW),
+                    )
+        render_status()
+        variation_gallery()
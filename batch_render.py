@@ -0,0 +1,303 @@
+"""
+Headless batch renders from a JSONL job file.
+
+    python batch_render.py jobs.jsonl --output renders/
+    python batch_render.py jobs.jsonl --output renders/ --renders 8 --prefetch 4
+
+One job per line; paths are relative to the job file:
+    {"id": "tower-3", "image": "captures/tower.png", "mask": "masks/tower.png",
+     "prompt": "glass office tower, dusk", "seeds": [1, 2]}
+    {"image": "captures/block.png", "points": [[420, 310], [900, 515]], "labels": [1, 1],
+     "prompt": "brick warehouse"}
+    {"image": "captures/site.png", "boxes": [[100, 80, 400, 300]], "prompt": "...",
+     "workflow": "BuildingEditFast.json", "original": "captures/site_context.png"}
+
+The mask is white where to render. Instead of a mask, a job may give Magic
+Wand clicks ("points", "labels", default all positive) or "boxes", which
+are segmented with the configured segmenter. "seeds" default to [1]; -1
+draws a random seed, and the seed drawn is the one recorded in the
+results. "id" defaults to the line number.
+
+Jobs are streamed: up to --renders are rendering at once while up to
+--prefetch more are loaded and segmented ahead of them, so the render hosts
+(EARTH_CANVAS_COMFYUI, see render_scheduler) stay busy. Each finished job
+writes its images to --output and appends a record to results.jsonl there.
+That file is the checkpoint: rerunning skips jobs already recorded as done.
+Jobs are queued in file order within windows of ORDER_WINDOW, reordered so
+that jobs sharing a workflow and capture follow each other and ComfyUI can
+reuse their model loads, depth maps and encodes (see reuse_order).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import tracing
+from pass_websocket import SEED_MAX
+from render_jobs import render_design, render_design_variations
+from render_scheduler import RENDER_HOSTS
+from submission_optimizer import order_for_reuse, prune
+from workflow_template import WorkflowError, get_template
+
+DEFAULT_WORKFLOW = "BuildingEditFast.json"
+RESULTS_FILE = "results.jsonl"
+DONE = "done"
+FAILED = "failed"
+# Jobs reordered together for cache reuse.
+ORDER_WINDOW = 64
+
+# One segmentation model per process: jobs segment one at a time.
+_segment_lock = threading.Lock()
+
+
+def read_jobs(path):
+    """Yield the jobs of a JSONL file, with "id" filled in from the line number."""
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            job = json.loads(line)
+            job.setdefault("id", str(number))
+            job["id"] = str(job["id"])
+            yield job
+
+
+def recorded_jobs(results_path, include_failed=True):
+    """
+    Ids whose latest record in a results file is done (or failed, with
+    include_failed). A torn last line from a crash is ignored.
+    """
+    latest = {}
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                latest[record["id"]] = record["status"]
+    return {job_id for job_id, status in latest.items() if status == DONE or include_failed}
+
+
+class ResultLog:
+    """Append-only results.jsonl; every record is flushed to disk before the next job is reported."""
+
+    def __init__(self, path):
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _load_rgb(path):
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+def job_mask(job, image, base_dir):
+    """The job's render mask: uint8 (0 / 255) at the image size."""
+    if "mask" in job:
+        with Image.open(os.path.join(base_dir, job["mask"])) as mask_image:
+            mask = np.asarray(mask_image.convert("L").resize(image.size, Image.NEAREST))
+        return np.where(mask > 127, 255, 0).astype(np.uint8)
+
+    # Imported here so mask-only batches never load a model.
+    from hires_segmentation import segment_selection
+    from segmenters import segment_objects
+
+    with _segment_lock:
+        if "points" in job:
+            points = job["points"]
+            labels = job.get("labels") or [1] * len(points)
+            selection = {"points": [], "labels": [], "logits": None, "crop_box": None, "crop_logits": None}
+            mask, _ = segment_selection(image, selection, points, labels)
+        elif "boxes" in job:
+            results = segment_objects(image, [{"box": box} for box in job["boxes"]], multimask_output=False)
+            mask = np.any([m > 0 for m, _, _ in results], axis=0)
+        else:
+            raise ValueError("job needs a mask, points or boxes")
+    return np.where(mask, 255, 0).astype(np.uint8)
+
+
+def _workflow_path(job, base_dir):
+    workflow = os.path.abspath(os.path.join(base_dir, job.get("workflow", DEFAULT_WORKFLOW)))
+    if not os.path.exists(workflow):
+        workflow = os.path.abspath(job.get("workflow", DEFAULT_WORKFLOW))
+    return workflow
+
+
+def _stand_in_graph(job, base_dir):
+    """
+    The pruned submission graph of a job with its file paths standing in
+    for the upload names, which are only known once the inputs are encoded:
+    jobs on the same capture get the same names, as their uploads would.
+    Empty when the workflow cannot be built; the job then fails on its own.
+    """
+    image = job.get("image")
+    try:
+        graph = get_template(_workflow_path(job, base_dir)).build(
+            prompt=job.get("prompt"),
+            source_image=image,
+            mask_image=job.get("mask", f"{job['id']}.mask"),
+            original_image=job.get("original", image),
+        )
+        return prune(graph)[0]
+    except (OSError, WorkflowError):
+        return {}
+
+
+def _reordered(batch, base_dir):
+    order = order_for_reuse([_stand_in_graph(job, base_dir) for job in batch])
+    return [batch[i] for i in order]
+
+
+def reuse_order(jobs, base_dir, window=ORDER_WINDOW):
+    """
+    Yield `jobs`, `window` at a time, in the order of
+    submission_optimizer.order_for_reuse, so consecutive prompts share
+    their expensive nodes.
+    """
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) == window:
+            yield from _reordered(batch, base_dir)
+            batch = []
+    yield from _reordered(batch, base_dir)
+
+
+def _safe_name(job_id):
+    return re.sub(r"[^\w.-]", "_", job_id)
+
+
+def _save(image, path):
+    tmp = f"{path}.tmp"
+    image.save(tmp, format="PNG")
+    os.replace(tmp, path)
+
+
+def run_job(job, base_dir, output_dir, render_slots):
+    """Load, segment and render one job. Returns its results record."""
+    record = {"id": job["id"], "timings": {}}
+    timings = record["timings"]
+    started = time.perf_counter()
+    try:
+        with tracing.trace("batch_job", job=job["id"]):
+            image = _load_rgb(os.path.join(base_dir, job["image"]))
+            original = _load_rgb(os.path.join(base_dir, job["original"])) if "original" in job else image
+            timings["load_s"] = round(time.perf_counter() - started, 3)
+
+            mark = time.perf_counter()
+            mask = job_mask(job, image, base_dir)
+            if not mask.any():
+                raise ValueError("mask is empty")
+            timings["mask_s"] = round(time.perf_counter() - mark, 3)
+
+            workflow = _workflow_path(job, base_dir)
+            # Random seeds are drawn here so that the results record the seed rendered.
+            seeds = [random.randrange(SEED_MAX) if seed == -1 else seed for seed in map(int, job.get("seeds", [1]))]
+            with render_slots:
+                mark = time.perf_counter()
+                if len(seeds) == 1:
+                    images = [render_design(job["prompt"], image, mask, original, workflow, seed=seeds[0])]
+                else:
+                    variants = [(job["prompt"], seed) for seed in seeds]
+                    images = render_design_variations(variants, image, mask, original, workflow)
+                timings["render_s"] = round(time.perf_counter() - mark, 3)
+
+            outputs = []
+            for i, (seed, rendered) in enumerate(zip(seeds, images)):
+                path = os.path.join(output_dir, f"{_safe_name(job['id'])}_{i}.png")
+                _save(rendered, path)
+                outputs.append({"path": os.path.relpath(path, output_dir), "seed": seed})
+            record.update(status=DONE, outputs=outputs)
+    except Exception as e:
+        record.update(status=FAILED, error=f"{type(e).__name__}: {e}")
+    timings["total_s"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a JSONL file of jobs without the UI.")
+    parser.add_argument("jobs", help="JSONL job file")
+    parser.add_argument("--output", required=True, help="directory for renders and results.jsonl")
+    parser.add_argument(
+        "--renders",
+        type=int,
+        default=2 * len(RENDER_HOSTS),
+        help="jobs rendering at once (default: two per render host, so none idles between prompts)",
+    )
+    parser.add_argument("--prefetch", type=int, default=2, help="jobs loaded and segmented ahead of the renders")
+    parser.add_argument("--retry-failed", action="store_true", help="also rerun jobs recorded as failed")
+    args = parser.parse_args()
+
+    tracing.start_exporters()
+    os.makedirs(args.output, exist_ok=True)
+    base_dir = os.path.dirname(os.path.abspath(args.jobs))
+    results_path = os.path.join(args.output, RESULTS_FILE)
+    done = recorded_jobs(results_path, include_failed=not args.retry_failed)
+
+    log = ResultLog(results_path)
+    render_slots = threading.BoundedSemaphore(args.renders)
+    # Jobs in the pipeline at once, so the job file is read only as fast as it is rendered
+    in_flight = threading.BoundedSemaphore(args.renders + args.prefetch)
+    counts = {DONE: 0, FAILED: 0, "skipped": 0}
+    counts_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def finish(future):
+        try:
+            record = future.result()
+            try:
+                log.append(record)
+            except OSError as e:
+                # Not checkpointed: a rerun renders the job again
+                record.update(status=FAILED, error=f"{RESULTS_FILE} not written: {e}")
+            with counts_lock:
+                counts[record["status"]] += 1
+            status = record["status"] if record["status"] == DONE else f"{FAILED}: {record['error']}"
+            print(f"[{record['id']}] {status} in {record['timings']['total_s']}s", flush=True)
+        finally:
+            # Also when the record cannot be written, or the feeder would block forever
+            in_flight.release()
+
+    def pending():
+        for job in read_jobs(args.jobs):
+            if job["id"] in done:
+                counts["skipped"] += 1
+                continue
+            yield job
+
+    with ThreadPoolExecutor(max_workers=args.renders + args.prefetch, thread_name_prefix="batch") as pool:
+        for job in reuse_order(pending(), base_dir):
+            in_flight.acquire()
+            pool.submit(run_job, job, base_dir, args.output, render_slots).add_done_callback(finish)
+    log.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{counts[DONE]} done, {counts[FAILED]} failed, {counts['skipped']} skipped "
+        f"in {elapsed:.1f}s ({counts[DONE] / elapsed * 60:.1f} jobs/min)"
+    )
+    sys.exit(1 if counts[FAILED] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare N sequential renders against one fan-out submission of the same
+N variants.
+
+    python benchmarks/bench_variations.py image.png mask.png \
+        --prompt "neoclassical facade" --prompt "brutalist facade" --seeds 3
+
+Needs a ComfyUI server (EARTH_CANVAS_COMFYUI). Both runs bypass the render
+cache and use distinct seed ranges, so neither reuses the other's samples.
+A warm-up render loads the models first so both runs start warm.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pass_websocket import get_images, run_pass, upload_image  # noqa: E402
+from workflow_template import get_template, merge_graphs  # noqa: E402
+
+
+def _png(path):
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.open(path).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("image")
+    parser.add_argument("mask")
+    parser.add_argument("--original", help="defaults to the image")
+    parser.add_argument("--prompt", action="append", required=True)
+    parser.add_argument("--seeds", type=int, default=2, help="seeds per prompt")
+    parser.add_argument("--workflow", default="BuildingEditFast.json")
+    args = parser.parse_args()
+
+    template = get_template(args.workflow)
+    source = upload_image(_png(args.image))
+    mask = upload_image(_png(args.mask))
+    original = upload_image(_png(args.original)) if args.original else source
+
+    def variants(first_seed):
+        return [
+            {"prompt": p, "seed": first_seed + i, "source_image": source, "mask_image": mask, "original_image": original}
+            for p in args.prompt
+            for i in range(args.seeds)
+        ]
+
+    n = len(args.prompt) * args.seeds
+    graphs = [template.build(**v) for v in variants(0)]
+    merged, _ = merge_graphs(graphs)
+    print(f"{n} variants: {sum(len(g) for g in graphs)} nodes submitted separately, {len(merged)} merged")
+
+    run_pass(args.prompt[0], source, mask, original, args.workflow, seed=10_000)
+
+    start = time.perf_counter()
+    for v in variants(1_000):
+        run_pass(v["prompt"], source, mask, original, args.workflow, seed=v["seed"])
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    merged, _ = merge_graphs([template.build(**v) for v in variants(2_000)])
+    get_images(merged)
+    fanout = time.perf_counter() - start
+
+    print(f"sequential: {sequential:.1f}s ({sequential / n:.1f}s per variation)")
+    print(f"fan-out:    {fanout:.1f}s ({fanout / n:.1f}s per variation)")
+    print(f"speedup:    {sequential / fanout:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
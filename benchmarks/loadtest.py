@@ -0,0 +1,211 @@
+"""
+End-to-end load test of the render client.
+
+Many simulated editor sessions render concurrently through the real client
+path (pass_websocket.render_images: uploads, /prompt, websocket events,
+history, downloads). By default an in-process mock ComfyUI server
+(mock_comfy.py) is started, or --hosts of them behind the render
+scheduler; --server points the test at running servers instead.
+
+    python benchmarks/loadtest.py --sessions 32 --renders 5 --steps 20 --step-ms 10 --workers 4
+    python benchmarks/loadtest.py --hosts 4 --sessions 32 --kill-after 2
+    python benchmarks/loadtest.py --server 127.0.0.1:8188,127.0.0.1:8189 --sessions 8
+
+Reports render turnaround percentiles, throughput, error rates, and client
+and server connection counts, as text or JSON (--json).
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pass_websocket  # noqa: E402
+import render_scheduler  # noqa: E402
+import submission_optimizer  # noqa: E402
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BuildingEditFast.json")
+
+
+def _png(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def session_inputs(index, size):
+    """Distinct source / mask / original per session, so uploads are not shared."""
+    rng = np.random.default_rng(index)
+    width, height = size
+    pixels = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    source = Image.fromarray(pixels)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 4 : height // 2, width // 4 : width // 2] = 255
+    return _png(source), _png(Image.fromarray(mask)), _png(source)
+
+
+def run_session(index, args, latencies, errors, lock, start_barrier):
+    source, mask, original = session_inputs(index, (args.width, args.height))
+    start_barrier.wait()
+    for i in range(args.renders):
+        started = time.perf_counter()
+        try:
+            pass_websocket.render_images(
+                f"session {index} render {i}", source, mask, original, WORKFLOW
+            )
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+        else:
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000.0)
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 4) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the ComfyUI render client.")
+    parser.add_argument("--server", help="comma-separated host:port of running (mock) ComfyUI servers; default: start mocks")
+    parser.add_argument("--hosts", type=int, default=1, help="mock servers to start")
+    parser.add_argument("--kill-after", type=float, help="seconds after which the first mock host dies")
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--renders", type=int, default=5, help="renders per session")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pause between a session's renders")
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    mock = parser.add_argument_group("mock server (ignored with --server)")
+    mock.add_argument("--steps", type=int, default=10)
+    mock.add_argument("--step-ms", type=float, default=5.0)
+    mock.add_argument("--queue-ms", type=float, default=0.0)
+    mock.add_argument("--preview-every", type=int, default=5)
+    mock.add_argument("--failure-rate", type=float, default=0.0)
+    mock.add_argument("--drop-rate", type=float, default=0.0)
+    mock.add_argument("--http-latency-ms", type=float, default=0.0)
+    mock.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    servers = []
+    if args.server:
+        addresses = [a.strip() for a in args.server.split(",") if a.strip()]
+    else:
+        import mock_comfy
+
+        servers = [
+            mock_comfy.start(
+                mock_comfy.MockConfig(
+                    queue_ms=args.queue_ms,
+                    steps=args.steps,
+                    step_ms=args.step_ms,
+                    preview_every=args.preview_every,
+                    failure_rate=args.failure_rate,
+                    drop_rate=args.drop_rate,
+                    http_latency_ms=args.http_latency_ms,
+                    workers=args.workers,
+                    seed=i,
+                )
+            )
+            for i in range(args.hosts)
+        ]
+        addresses = [server.address for server in servers]
+    scheduler = render_scheduler.configure(addresses)
+    if args.kill_after is not None and servers:
+        threading.Timer(args.kill_after, servers[0].kill).start()
+
+    latencies = []
+    errors = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.sessions + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(i, args, latencies, errors, lock, barrier), daemon=True)
+        for i in range(args.sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = args.sessions * args.renders
+    clients = [backend.client for backend in scheduler.backends]
+    report = {
+        "servers": addresses,
+        "sessions": args.sessions,
+        "renders": total,
+        "succeeded": len(latencies),
+        "errors": dict(errors),
+        "error_rate": round(sum(errors.values()) / total, 4) if total else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "turnaround_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(max(latencies), 4) if latencies else None,
+        },
+        "client": {
+            "reconnects": sum(c.reconnects for c in clients),
+            "uploads": sum(c.uploads for c in clients),
+            "upload_skips": sum(c.upload_skips for c in clients),
+        },
+        "nodes": submission_optimizer.stats(),
+        "hosts": scheduler.stats(),
+        "server_stats": {},
+    }
+    for address in addresses:
+        try:
+            report["server_stats"][address] = requests.get(f"http://{address}/mock/stats", timeout=5).json()
+        except (requests.RequestException, ValueError):
+            pass
+    scheduler.close()
+    for server in servers:
+        if not server.killed:
+            server.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    t = report["turnaround_s"]
+    print(f"{report['succeeded']}/{total} renders in {report['elapsed_s']}s ({report['throughput_per_s']}/s)")
+    print(f"turnaround p50 {t['p50']}s  p95 {t['p95']}s  p99 {t['p99']}s  max {t['max']}s")
+    print(f"errors {report['errors'] or 0} (rate {report['error_rate']})")
+    print(
+        f"client: {report['client']['reconnects']} reconnects, "
+        f"{report['client']['uploads']} uploads, {report['client']['upload_skips']} skipped"
+    )
+    nodes = report["nodes"]
+    if nodes.get("renders"):
+        print(
+            f"nodes per render: {nodes['nodes'] / nodes['renders']:.1f} submitted, "
+            f"{nodes['executed'] / nodes['renders']:.1f} executed, {nodes['cached'] / nodes['renders']:.1f} cached, "
+            f"{nodes['pruned'] / nodes['renders']:.1f} pruned"
+        )
+    for host in report["hosts"]:
+        line = f"{host['address']}: {host['renders']} renders, {host['failures']} failures"
+        stats = report["server_stats"].get(host["address"])
+        if stats:
+            line += (
+                f", {stats['http_connections']} HTTP connections, "
+                f"{stats['ws_connections']} websocket connections, {stats['ws_dropped']} dropped"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
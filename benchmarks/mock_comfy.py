@@ -0,0 +1,480 @@
+"""
+Local stand-in for a ComfyUI server, for exercising the render client
+without a GPU host.
+
+    python benchmarks/mock_comfy.py --port 8188 --steps 20 --step-ms 50
+
+Implements the parts of the API the app uses:
+    POST /prompt            queue a workflow -> {"prompt_id", "number", "node_errors"}
+    GET  /history/<id>      outputs of a finished prompt
+    GET  /queue             running and pending prompts
+    GET  /view              an uploaded input or a rendered output (HEAD too)
+    POST /upload/image      multipart upload into the input folder
+    GET  /ws?clientId=      event stream: status (on connect and on every
+                            queue change), execution_start,
+                            execution_cached, executing, progress, binary
+                            preview frames, executed, execution_error,
+                            execution_success
+    GET  /mock/stats        connection and request counters
+
+Prompts run one at a time per worker (like one GPU) after a configurable
+queue delay. Each step sends a progress event; previews are sent every few
+steps. Failures (execution_error) and dropped websockets are injected at
+configurable rates. Outputs are flat images of the "Load Image" input's
+size, one per SaveImage / PreviewImage node. Like ComfyUI, nodes identical
+to one in the previous prompt are reported as cached and not executed.
+"""
+import argparse
+import base64
+import email.parser
+import email.policy
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from submission_optimizer import node_signatures  # noqa: E402
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTPUT_NODES = ("SaveImage", "PreviewImage")
+# Binary frame types, as in ComfyUI's server.BinaryEventTypes.
+PREVIEW_IMAGE = 1
+JPEG = 1
+
+
+class MockConfig:
+    def __init__(
+        self,
+        queue_ms=0.0,
+        steps=10,
+        step_ms=20.0,
+        preview_every=5,
+        failure_rate=0.0,
+        drop_rate=0.0,
+        http_latency_ms=0.0,
+        workers=1,
+        seed=None,
+        prompt_status=200,
+    ):
+        self.queue_ms = queue_ms
+        self.steps = steps
+        self.step_ms = step_ms
+        self.preview_every = preview_every
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.http_latency_ms = http_latency_ms
+        self.workers = workers
+        self.rng = random.Random(seed)
+        # Status /prompt answers with; anything but 200 rejects every prompt
+        self.prompt_status = prompt_status
+
+
+class _WebSocket:
+    """Server side of one websocket: unmasked frames out, masked frames in."""
+
+    def __init__(self, sock, rfile):
+        self.sock = sock
+        # Frames sent right after the handshake may already sit in the
+        # handler's read buffer, so reads go through it.
+        self.rfile = rfile
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def send(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack("!BB", 0x80 | opcode, n)
+        elif n < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message):
+        self.send(0x1, json.dumps(message).encode("utf-8"))
+
+    def _read(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError("client went away")
+        return data
+
+    def serve(self):
+        """Answer pings and close frames until the client disconnects."""
+        try:
+            while not self.closed:
+                first, second = self._read(2)
+                opcode, length = first & 0x0F, second & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self._read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self._read(8))[0]
+                mask = self._read(4) if second & 0x80 else b"\0\0\0\0"
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._read(length)))
+                if opcode == 0x8:
+                    self.send(0x8, payload[:2])
+                    break
+                if opcode == 0x9:
+                    self.send(0xA, payload)
+        except (OSError, ConnectionError):
+            pass
+        self.drop()
+
+    def drop(self):
+        with self._lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class MockComfyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=None):
+        super().__init__(address, _Handler)
+        self.config = config or MockConfig()
+        self.inputs = {}
+        self.outputs = {}
+        self.history = {}
+        self.sockets = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.number = 0
+        self.running = {}
+        # Node signatures of the last prompt that ran, as in ComfyUI's cache
+        self.last_signatures = set()
+        self.killed = False
+        self.stats = {
+            "http_connections": 0,
+            "ws_connections": 0,
+            "ws_open": 0,
+            "ws_dropped": 0,
+            "requests": {},
+            "prompts": 0,
+            "failed": 0,
+            "uploads": 0,
+        }
+        self._previews = {}
+        for i in range(self.config.workers):
+            threading.Thread(target=self._worker, name=f"mock-gpu-{i}", daemon=True).start()
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    # Execution
+
+    def send(self, client_id, message):
+        for ws in list(self.sockets.get(client_id, ())):
+            ws.send_json(message)
+
+    def queue_remaining(self):
+        return self.queue.qsize() + len(self.running)
+
+    def broadcast_status(self):
+        message = {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}}
+        with self.lock:
+            sockets = [ws for client in self.sockets.values() for ws in client]
+        for ws in sockets:
+            ws.send_json(message)
+
+    def kill(self):
+        """Simulate the host going away: stop serving and drop every websocket."""
+        self.killed = True
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            sockets = [ws for client in self.sockets.values() for ws in client]
+        for ws in sockets:
+            ws.drop()
+
+    def _preview(self, size):
+        data = self._previews.get(size)
+        if data is None:
+            buf = io.BytesIO()
+            Image.new("RGB", size, (90, 120, 160)).save(buf, format="JPEG")
+            data = self._previews[size] = struct.pack("!II", PREVIEW_IMAGE, JPEG) + buf.getvalue()
+        return data
+
+    def _input_size(self, prompt):
+        for node in prompt.values():
+            if node["class_type"] == "LoadImage" and node.get("_meta", {}).get("title") == "Load Image":
+                data = self.inputs.get(node["inputs"].get("image"))
+                if data is not None:
+                    return Image.open(io.BytesIO(data)).size
+        return (512, 512)
+
+    def _worker(self):
+        config = self.config
+        while True:
+            prompt_id, prompt, client_id = self.queue.get()
+            with self.lock:
+                self.running[prompt_id] = client_id
+            time.sleep(config.queue_ms / 1000.0)
+            try:
+                if not self.killed:
+                    self._execute(prompt_id, prompt, client_id)
+            finally:
+                with self.lock:
+                    self.running.pop(prompt_id, None)
+                self.broadcast_status()
+
+    def _execute(self, prompt_id, prompt, client_id):
+        config = self.config
+
+        def send(kind, data):
+            self.send(client_id, {"type": kind, "data": {**data, "prompt_id": prompt_id}})
+
+        signatures = node_signatures(prompt)
+        cached = [node_id for node_id, signature in signatures.items() if signature in self.last_signatures]
+        self.last_signatures = set(signatures.values())
+        send("execution_start", {"timestamp": int(time.time() * 1000)})
+        send("execution_cached", {"nodes": cached, "timestamp": int(time.time() * 1000)})
+        fail_at = config.steps // 2 if config.rng.random() < config.failure_rate else None
+        drop_at = config.steps // 3 if config.rng.random() < config.drop_rate else None
+        sampler = next((i for i, n in prompt.items() if n["class_type"].startswith("KSampler")), None)
+        for node_id in signatures:
+            if node_id not in cached and node_id != sampler and prompt[node_id]["class_type"] not in OUTPUT_NODES:
+                send("executing", {"node": node_id, "display_node": node_id})
+        send("executing", {"node": sampler, "display_node": sampler})
+        preview = self._preview((64, 64))
+        for step in range(1, config.steps + 1):
+            time.sleep(config.step_ms / 1000.0)
+            send("progress", {"value": step, "max": config.steps, "node": sampler})
+            if config.preview_every and step % config.preview_every == 0:
+                for ws in list(self.sockets.get(client_id, ())):
+                    ws.send(0x2, preview)
+            if step == drop_at:
+                for ws in list(self.sockets.get(client_id, ())):
+                    ws.drop()
+                    self.count("ws_dropped")
+            if step == fail_at:
+                self.count("failed")
+                send(
+                    "execution_error",
+                    {
+                        "node_id": sampler,
+                        "node_type": prompt[sampler]["class_type"] if sampler else None,
+                        "exception_message": "injected failure",
+                        "exception_type": "RuntimeError",
+                        "traceback": [],
+                    },
+                )
+                with self.lock:
+                    self.history[prompt_id] = {"prompt": [], "outputs": {}, "status": {"status_str": "error", "completed": False}}
+                return
+
+        size = self._input_size(prompt)
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node["class_type"] not in OUTPUT_NODES:
+                continue
+            filename = f"mock_{prompt_id[:8]}_{node_id}.png"
+            buf = io.BytesIO()
+            Image.new("RGB", size, (200, 160, 120)).save(buf, format="PNG", compress_level=1)
+            with self.lock:
+                self.outputs[filename] = buf.getvalue()
+            images = [{"filename": filename, "subfolder": "", "type": "output"}]
+            outputs[node_id] = {"images": images}
+            send("executing", {"node": node_id, "display_node": node_id})
+            send("executed", {"node": node_id, "display_node": node_id, "output": {"images": images}})
+        with self.lock:
+            self.history[prompt_id] = {"prompt": [], "outputs": outputs, "status": {"status_str": "success", "completed": True}}
+        send("execution_success", {"timestamp": int(time.time() * 1000)})
+        send("executing", {"node": None})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count("http_connections")
+
+    def parse_request(self):
+        # A killed host drops requests on keep-alive connections opened
+        # before kill(), as a dead server would.
+        if self.server.killed:
+            self.close_connection = True
+            return False
+        return super().parse_request()
+
+    def _send(self, status, body=b"", content_type="application/json", head=False):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _route(self):
+        url = urlparse(self.path)
+        endpoint = "/history" if url.path.startswith("/history/") else url.path
+        with self.server.lock:
+            requests = self.server.stats["requests"]
+            requests[endpoint] = requests.get(endpoint, 0) + 1
+        if self.server.config.http_latency_ms and endpoint != "/ws":
+            time.sleep(self.server.config.http_latency_ms / 1000.0)
+        return url, parse_qs(url.query)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        url, query = self._route()
+        server = self.server
+        if url.path == "/ws":
+            return self._websocket(query.get("clientId", [""])[0])
+        if url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/") :]
+            with server.lock:
+                entry = server.history.get(prompt_id)
+            return self._send(200, {prompt_id: entry} if entry is not None else {}, head=head)
+        if url.path == "/view":
+            name = query.get("filename", [""])[0]
+            store = server.inputs if query.get("type", ["output"])[0] == "input" else server.outputs
+            data = store.get(name)
+            if data is None:
+                return self._send(404, {"error": "not found"}, head=head)
+            return self._send(200, data, content_type="image/png", head=head)
+        if url.path == "/queue":
+            with server.lock:
+                running = [[0, prompt_id, {}, {}, []] for prompt_id in server.running]
+            pending = [[0, None, {}, {}, []]] * server.queue.qsize()
+            return self._send(200, {"queue_running": running, "queue_pending": pending}, head=head)
+        if url.path == "/mock/stats":
+            with server.lock:
+                return self._send(200, json.loads(json.dumps(server.stats)), head=head)
+        self._send(404, {"error": "not found"}, head=head)
+
+    def do_POST(self):
+        url, _ = self._route()
+        server = self.server
+        if url.path == "/prompt":
+            payload = json.loads(self._body())
+            prompt = payload.get("prompt")
+            if not isinstance(prompt, dict) or not prompt:
+                return self._send(400, {"error": {"type": "invalid_prompt", "message": "no prompt"}, "node_errors": {}})
+            if server.config.prompt_status != 200:
+                return self._send(server.config.prompt_status, {"error": {"type": "injected", "message": "injected error"}})
+            prompt_id = str(uuid.uuid4())
+            with server.lock:
+                server.number += 1
+                number = server.number
+                server.stats["prompts"] += 1
+            server.queue.put((prompt_id, prompt, payload.get("client_id", "")))
+            server.broadcast_status()
+            return self._send(200, {"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        if url.path == "/upload/image":
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("latin-1")
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + self._body())
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            image = fields.get("image")
+            if image is None:
+                return self._send(400, {"error": "no image"})
+            name = image.get_filename() or hashlib.sha256(image.get_content()).hexdigest()
+            with server.lock:
+                server.inputs[name] = image.get_content()
+                server.stats["uploads"] += 1
+            return self._send(200, {"name": name, "subfolder": "", "type": "input"})
+        self._send(404, {"error": "not found"})
+
+    def _websocket(self, client_id):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+            return self._send(400, {"error": "expected a websocket upgrade"})
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        server = self.server
+        ws = _WebSocket(self.connection, self.rfile)
+        with server.lock:
+            server.sockets.setdefault(client_id, set()).add(ws)
+            server.stats["ws_connections"] += 1
+            server.stats["ws_open"] += 1
+        ws.send_json({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": server.queue_remaining()}}, "sid": client_id}})
+        try:
+            ws.serve()
+        finally:
+            with server.lock:
+                server.sockets.get(client_id, set()).discard(ws)
+                server.stats["ws_open"] -= 1
+            self.close_connection = True
+
+
+def start(config=None, host="127.0.0.1", port=0):
+    """Start a mock server on a background thread; returns it (see .address)."""
+    server = MockComfyServer((host, port), config)
+    threading.Thread(target=server.serve_forever, name="mock-comfy", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock ComfyUI server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--queue-ms", type=float, default=0.0, help="delay before a prompt starts")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--step-ms", type=float, default=20.0)
+    parser.add_argument("--preview-every", type=int, default=5, help="steps between preview frames (0: none)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of prompts that fail")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of prompts whose websocket is dropped")
+    parser.add_argument("--http-latency-ms", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=1, help="prompts executed in parallel")
+    parser.add_argument("--prompt-status", type=int, default=200, help="HTTP status /prompt answers every prompt with")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        queue_ms=args.queue_ms,
+        steps=args.steps,
+        step_ms=args.step_ms,
+        preview_every=args.preview_every,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        http_latency_ms=args.http_latency_ms,
+        workers=args.workers,
+        prompt_status=args.prompt_status,
+    )
+    server = MockComfyServer((args.host, args.port), config)
+    print(f"Mock ComfyUI on http://{args.host}:{args.port}")
+    server.serve_forever()
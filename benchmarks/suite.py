@@ -0,0 +1,248 @@
+"""
+Offline benchmarks for the app's hot paths, runnable on a CPU-only machine.
+
+    python benchmarks/suite.py --output bench.json
+    python benchmarks/suite.py --only geometry,encode --sizes 1024,4096
+    python benchmarks/suite.py --only sam2 --tiers tiny,small --repeat 3
+
+Groups:
+    sam2      sam2_predict per model tier, cold (embedding computed) and
+              warm (embedding reused from the cache)
+    geometry  mask -> Fabric polygons, flatten_masks, render-mask
+              rasterization and mask resize on synthetic masks
+    encode    PNG (default and fast), lossless WebP and JPEG encodes
+
+Results are written as JSON: a "meta" block describing the machine and
+library versions, and one entry per case with timings in milliseconds.
+Cases whose dependencies are missing are recorded as skipped.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mask_polygons import flatten_masks, mask_to_fabric  # noqa: E402
+from mask_raster import build_render_mask, pack_mask  # noqa: E402
+
+GROUPS = ("sam2", "geometry", "encode")
+DEFAULT_SIZES = (512, 1024, 2048, 4096)
+DEFAULT_TIERS = ("tiny", "small", "base+", "large")
+# Display width the canvas shows captures at.
+DISPLAY_WIDTH = 800
+
+
+def measure(fn, repeat, setup=None):
+    """Run `fn` `repeat` times (after one warm-up) and return timing stats in ms."""
+    if setup is not None:
+        setup()
+    fn()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": repeat,
+        "median_ms": round(statistics.median(times), 3),
+        "min_ms": round(min(times), 3),
+        "mean_ms": round(statistics.fmean(times), 3),
+    }
+
+
+def synthetic_mask(size, seed=0, shapes=12):
+    """Building-like blobs: rotated rectangles and ellipses on an aspect 3:2 frame."""
+    rng = np.random.default_rng(seed)
+    height = size * 2 // 3
+    mask = np.zeros((height, size), dtype=np.uint8)
+    for _ in range(shapes):
+        cx, cy = rng.uniform(0.1, 0.9) * size, rng.uniform(0.1, 0.9) * height
+        w, h = rng.uniform(0.03, 0.15) * size, rng.uniform(0.03, 0.15) * size
+        if rng.random() < 0.5:
+            box = cv2.boxPoints(((cx, cy), (w, h), rng.uniform(0, 90)))
+            cv2.fillPoly(mask, [np.rint(box).astype(np.int32)], 255)
+        else:
+            cv2.ellipse(mask, (int(cx), int(cy)), (int(w / 2), int(h / 2)), rng.uniform(0, 180), 0, 360, 255, -1)
+    return mask
+
+
+def synthetic_image(size, seed=0):
+    """Smooth gradients with texture noise, closer to a capture than pure noise."""
+    rng = np.random.default_rng(seed)
+    height = size * 2 // 3
+    y, x = np.mgrid[0:height, 0:size].astype(np.float32)
+    base = np.stack([x / size, y / height, (x + y) / (size + height)], axis=-1) * 200
+    base += rng.normal(0, 8, base.shape).astype(np.float32)
+    return Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+
+def bench_geometry(sizes, repeat):
+    results = []
+    for size in sizes:
+        mask = synthetic_mask(size)
+        height, width = mask.shape
+        scale = DISPLAY_WIDTH / width
+        params = {"size": [width, height]}
+        results.append({
+            "name": "geometry.mask_to_fabric",
+            "params": params,
+            **measure(lambda: mask_to_fabric(mask, scale, scale), repeat),
+        })
+        stack = np.stack([mask, mask, mask]).astype(np.float32)[None]
+        results.append({
+            "name": "geometry.flatten_masks",
+            "params": {**params, "shape": list(stack.shape)},
+            **measure(lambda: flatten_masks([stack, stack]), repeat),
+        })
+        objects, _ = mask_to_fabric(mask, scale, scale)
+        display = (DISPLAY_WIDTH, int(round(height * scale)))
+        results.append({
+            "name": "geometry.rasterize_polygons",
+            "params": {**params, "polygons": len(objects)},
+            **measure(lambda: build_render_mask(objects, {}, (width, height), display), repeat),
+        })
+        sam_objects = [dict(obj, selection=0) for obj in objects]
+        packed = {0: pack_mask(mask)}
+        results.append({
+            "name": "geometry.render_mask_from_selection",
+            "params": params,
+            **measure(lambda: build_render_mask(sam_objects, packed, (width, height), display), repeat),
+        })
+        results.append({
+            "name": "geometry.resize_mask",
+            "params": {**params, "to": list(display)},
+            **measure(lambda: cv2.resize(mask, display, interpolation=cv2.INTER_NEAREST), repeat),
+        })
+    return results
+
+
+def bench_encode(sizes, repeat):
+    variants = (
+        ("png_default", "PNG", {}),
+        ("png_fast", "PNG", {"compress_level": 1}),
+        ("webp_lossless", "WEBP", {"lossless": True, "method": 0}),
+        ("jpeg_q95", "JPEG", {"quality": 95}),
+    )
+    results = []
+    for size in sizes:
+        image = synthetic_image(size)
+        mask = Image.fromarray(synthetic_mask(size))
+        for target_name, target in (("image", image), ("mask", mask)):
+            for name, fmt, options in variants:
+                if fmt == "JPEG" and target_name == "mask":
+                    continue
+
+                def encode():
+                    buf = io.BytesIO()
+                    target.save(buf, format=fmt, **options)
+                    return buf
+
+                results.append({
+                    "name": f"encode.{target_name}.{name}",
+                    "params": {"size": list(target.size), "bytes": len(encode().getvalue())},
+                    **measure(encode, repeat),
+                })
+    return results
+
+
+def bench_sam2(tiers, repeat):
+    try:
+        from embedding_cache import shared_cache
+        from sam_runner import sam2_predict
+    except ImportError as e:
+        return [{"name": "sam2", "skipped": f"{e}"}]
+
+    image = synthetic_image(1536)
+    points = np.array([[600, 400]], dtype=np.float32)
+    labels = np.array([1])
+    results = []
+    for tier in tiers:
+        try:
+            sam2_predict(image, points, labels, tier=tier)
+        except Exception as e:  # missing checkpoint, out of memory, ...
+            results.append({"name": "sam2.predict", "params": {"tier": tier}, "skipped": f"{e}"})
+            continue
+        params = {"tier": tier, "size": list(image.size)}
+        results.append({
+            "name": "sam2.predict_cold",
+            "params": params,
+            **measure(lambda: sam2_predict(image, points, labels, tier=tier), repeat, setup=shared_cache.clear),
+        })
+        results.append({
+            "name": "sam2.predict_warm",
+            "params": params,
+            **measure(lambda: sam2_predict(image, points, labels, tier=tier), repeat),
+        })
+    return results
+
+
+def _versions():
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__}
+    import PIL
+
+    versions["pillow"] = PIL.__version__
+    try:
+        import torch
+
+        versions["torch"] = torch.__version__
+    except ImportError:
+        pass
+    return versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's hot paths.")
+    parser.add_argument("--only", default=",".join(GROUPS), help=f"comma-separated groups from {GROUPS}")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="synthetic frame widths")
+    parser.add_argument("--tiers", default=",".join(DEFAULT_TIERS), help="SAM2 tiers")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    groups = [g for g in args.only.split(",") if g]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"unknown groups: {', '.join(sorted(unknown))}")
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    results = []
+    if "geometry" in groups:
+        results += bench_geometry(sizes, args.repeat)
+    if "encode" in groups:
+        results += bench_encode(sizes, args.repeat)
+    if "sam2" in groups:
+        results += bench_sam2(args.tiers.split(","), args.repeat)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "versions": _versions(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
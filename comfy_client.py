@@ -0,0 +1,373 @@
+"""
+Long-lived ComfyUI client.
+
+One client per server address and process owns a pooled HTTP session and a
+single websocket for its client_id. A reader thread routes websocket events
+to the render waiting on that `prompt_id`, so concurrent renders share one
+connection, and reconnects with backoff when the socket drops. Every call
+has a timeout, so one stuck socket does not block the app.
+"""
+import hashlib
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import requests
+import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+# Binary websocket frame types sent by ComfyUI.
+PREVIEW_IMAGE = 1
+
+HTTP_TIMEOUT = 30
+CONNECT_TIMEOUT = 5
+RENDER_TIMEOUT = 900
+# Without any event for this long, ask /history whether the prompt finished.
+HISTORY_POLL_INTERVAL = 15
+MAX_BACKOFF = 10
+
+_PROMPT_EVENTS = (
+    "execution_start",
+    "execution_cached",
+    "executing",
+    "executed",
+    "progress",
+    "execution_error",
+    "execution_interrupted",
+    "execution_success",
+)
+
+
+class ComfyError(RuntimeError):
+    pass
+
+
+def upload_name(data, extension="png"):
+    """Content-derived input file name used by ComfyClient.upload_image."""
+    return f"ec_{hashlib.sha256(data).hexdigest()[:32]}.{extension}"
+
+
+class _Watch:
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.events = queue.Queue()
+        self.queued_at = time.perf_counter()
+        self.started_at = None
+
+
+class ComfyClient:
+    def __init__(self, server_address, client_id=None, http_timeout=HTTP_TIMEOUT):
+        self.server_address = server_address
+        self.client_id = client_id or str(uuid.uuid4())
+        self.http_timeout = http_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._ws = None
+        self._ws_lock = threading.Lock()
+        self._reader = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._watches = {}
+        # Events for prompts not registered yet (they can arrive before
+        # /prompt returns the id), bounded to the most recent prompts.
+        self._orphans = OrderedDict()
+        self._executing = None
+        self.reconnects = 0
+        # References of inputs this server is known to hold, by file name.
+        self._uploaded = {}
+        self.uploads = 0
+        self.upload_skips = 0
+        # Server-wide queue length from the last "status" event or /queue call.
+        self.queue_remaining = 0
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address}"
+
+    # HTTP API
+
+    def queue_prompt(self, prompt):
+        p = {"prompt": prompt, "client_id": self.client_id}
+        response = self.session.post(f"{self.base_url}/prompt", json=p, timeout=self.http_timeout)
+        # A 5xx is the server's fault (the scheduler retries elsewhere), a
+        # 4xx the workflow's
+        if response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code != 200:
+            raise ComfyError(f"/prompt rejected the workflow: {response.text}")
+        return response.json()
+
+    def get_history(self, prompt_id):
+        response = self.session.get(f"{self.base_url}/history/{prompt_id}", timeout=self.http_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_queue_length(self, timeout=None):
+        """Running plus pending prompts on the server, from /queue."""
+        response = self.session.get(f"{self.base_url}/queue", timeout=timeout or self.http_timeout)
+        response.raise_for_status()
+        queue_state = response.json()
+        self.queue_remaining = len(queue_state.get("queue_running", ())) + len(queue_state.get("queue_pending", ()))
+        return self.queue_remaining
+
+    def holds(self, name):
+        """Whether this client uploaded (or found) input `name` on the server."""
+        return name in self._uploaded
+
+    @property
+    def connected(self):
+        return self._ws is not None
+
+    def get_image(self, filename, subfolder, folder_type):
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        with tracing.span("comfy.download"):
+            response = self.session.get(f"{self.base_url}/view", params=data, timeout=self.http_timeout)
+            response.raise_for_status()
+            return response.content
+
+    def upload_image(self, data, image_type="input", extension="png"):
+        """
+        Upload encoded image bytes to the server's input folder under a
+        name derived from their content, skipping the transfer when the
+        server already holds that file.
+        Returns: the reference to put in a LoadImage node.
+        """
+        name = upload_name(data, extension)
+        reference = self._uploaded.get(name)
+        if reference is not None:
+            self.upload_skips += 1
+            return reference
+        probe = self.session.head(
+            f"{self.base_url}/view",
+            params={"filename": name, "type": image_type},
+            timeout=self.http_timeout,
+        )
+        if probe.status_code == 200:
+            self.upload_skips += 1
+            self._uploaded[name] = name
+            return name
+        with tracing.span("comfy.upload"):
+            response = self.session.post(
+                f"{self.base_url}/upload/image",
+                files={"image": (name, data, f"image/{extension}")},
+                data={"type": image_type, "overwrite": "true"},
+                timeout=self.http_timeout,
+            )
+            response.raise_for_status()
+        result = response.json()
+        reference = result["name"]
+        if result.get("subfolder"):
+            reference = f"{result['subfolder']}/{reference}"
+        self.uploads += 1
+        self._uploaded[name] = reference
+        return reference
+
+    # Websocket
+
+    def _connect(self):
+        ws = websocket.WebSocket()
+        ws.connect(
+            f"ws://{self.server_address}/ws?clientId={self.client_id}",
+            timeout=CONNECT_TIMEOUT,
+        )
+        # Short receive timeout so the reader notices close() promptly.
+        ws.settimeout(1)
+        return ws
+
+    def ensure_connected(self):
+        with self._ws_lock:
+            # A dropped socket that is not None yet is being replaced by the reader.
+            if self._ws is None:
+                self._ws = self._connect()
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_loop, daemon=True)
+                self._reader.start()
+
+    def _reconnect(self, dead):
+        """Replace the dropped socket `dead`; False once nobody is waiting."""
+        delay = 0.5
+        while not self._closed:
+            with self._ws_lock:
+                if self._ws is not None and self._ws is not dead:
+                    return True
+                with self._lock:
+                    idle = not self._watches
+                if idle:
+                    # The next render reconnects on demand.
+                    self._ws = None
+                    self._reader = None
+                    return False
+            try:
+                ws = self._connect()
+            except (OSError, websocket.WebSocketException):
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+                continue
+            with self._ws_lock:
+                if self._ws is not None and self._ws is not dead:
+                    ws.close()
+                else:
+                    self._ws = ws
+                    self.reconnects += 1
+            return True
+        return False
+
+    def _read_loop(self):
+        while not self._closed:
+            ws = self._ws
+            try:
+                if ws is None:
+                    raise websocket.WebSocketConnectionClosedException()
+                out = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except (OSError, websocket.WebSocketException):
+                if not self._reconnect(ws):
+                    return
+                # Completion events may have been lost; waiters re-check /history.
+                self._broadcast({"type": "reconnect", "data": {}})
+                continue
+            if isinstance(out, str):
+                self._dispatch(json.loads(out))
+            elif len(out) > 8 and int.from_bytes(out[:4], "big") == PREVIEW_IMAGE:
+                prompt_id = self._executing
+                if prompt_id is not None:
+                    self._route(prompt_id, {"type": "preview", "data": out[8:]})
+
+    def _dispatch(self, message):
+        if message.get("type") == "status":
+            exec_info = ((message.get("data") or {}).get("status") or {}).get("exec_info") or {}
+            self.queue_remaining = exec_info.get("queue_remaining", self.queue_remaining)
+            return
+        if message.get("type") not in _PROMPT_EVENTS:
+            return
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+        if message["type"] == "executing":
+            self._executing = prompt_id if data.get("node") is not None else None
+        self._route(prompt_id, message)
+
+    def _route(self, prompt_id, message):
+        with self._lock:
+            watch = self._watches.get(prompt_id)
+            if watch is None:
+                self._orphans.setdefault(prompt_id, []).append(message)
+                while len(self._orphans) > 64:
+                    self._orphans.popitem(last=False)
+                return
+        watch.events.put(message)
+
+    def _broadcast(self, message):
+        with self._lock:
+            watches = list(self._watches.values())
+        for watch in watches:
+            watch.events.put(message)
+
+    def _register(self, prompt_id):
+        watch = _Watch(prompt_id)
+        with self._lock:
+            self._watches[prompt_id] = watch
+            for message in self._orphans.pop(prompt_id, ()):
+                watch.events.put(message)
+        return watch
+
+    def _unregister(self, watch):
+        with self._lock:
+            self._watches.pop(watch.prompt_id, None)
+
+    # Rendering
+
+    def wait(self, watch, on_event=None, timeout=RENDER_TIMEOUT):
+        """
+        Block until the watched prompt finishes and return its history entry.
+        - on_event: optional callback receiving every event for this prompt
+          (progress, executing, preview frames with raw image bytes, ...)
+        """
+        deadline = time.monotonic() + timeout
+        last_event = time.monotonic()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Prompt {watch.prompt_id} did not finish within {timeout}s")
+            try:
+                message = watch.events.get(timeout=min(remaining, 1.0))
+            except queue.Empty:
+                if time.monotonic() - last_event < HISTORY_POLL_INTERVAL:
+                    continue
+                message = {"type": "reconnect", "data": {}}
+            last_event = time.monotonic()
+            kind, data = message["type"], message["data"]
+            if kind == "reconnect":
+                history = self.get_history(watch.prompt_id)
+                if watch.prompt_id in history:
+                    return history[watch.prompt_id]
+                continue
+            if kind == "execution_start" and watch.started_at is None:
+                watch.started_at = time.perf_counter()
+                tracing.observe("comfy.queue_wait", watch.started_at - watch.queued_at)
+            if on_event is not None:
+                on_event(message)
+            if kind == "execution_error":
+                raise ComfyError(
+                    f"Node {data.get('node_id')} ({data.get('node_type')}) failed: "
+                    f"{data.get('exception_message')}"
+                )
+            if kind == "execution_interrupted":
+                raise ComfyError(f"Prompt {watch.prompt_id} was interrupted")
+            if kind == "executing" and data.get("node") is None:
+                tracing.observe("comfy.execute", time.perf_counter() - (watch.started_at or watch.queued_at))
+                return self.get_history(watch.prompt_id)[watch.prompt_id]
+
+    def run_prompt(self, prompt, on_event=None, timeout=RENDER_TIMEOUT):
+        """Queue a workflow, wait for it and return its history entry."""
+        self.ensure_connected()
+        prompt_id = self.queue_prompt(prompt)["prompt_id"]
+        watch = self._register(prompt_id)
+        try:
+            return self.wait(watch, on_event, timeout)
+        finally:
+            self._unregister(watch)
+
+    def get_images(self, prompt, on_event=None, timeout=RENDER_TIMEOUT):
+        """Run a workflow and download its output images: {node_id: [png bytes]}."""
+        history = self.run_prompt(prompt, on_event, timeout)
+        output_images = {}
+        for node_id, node_output in history["outputs"].items():
+            images_output = []
+            for image in node_output.get("images", ()):
+                images_output.append(
+                    self.get_image(image["filename"], image["subfolder"], image["type"])
+                )
+            output_images[node_id] = images_output
+        return output_images
+
+    def close(self):
+        self._closed = True
+        with self._ws_lock:
+            if self._ws is not None:
+                self._ws.close()
+                self._ws = None
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(server_address):
+    """Process-wide client for `server_address`, created on first use."""
+    with _clients_lock:
+        client = _clients.get(server_address)
+        if client is None:
+            client = _clients[server_address] = ComfyClient(server_address)
+        return client
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Memory budget for cached image embeddings. One SAM2 hiera-large entry
+# (image_embed + high_res_feats) is roughly 16 MB in fp32.
+DEFAULT_BUDGET_MB = int(os.environ.get("EARTH_CANVAS_EMBEDDING_CACHE_MB", "512"))
+
+
+def image_key(image):
+    """
+    Content hash of an image, used as the embedding cache key.
+    - image: PIL.Image or numpy array
+    Returns: hex digest string
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if hasattr(image, "mode") and hasattr(image, "tobytes"):
+        h.update(f"{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+    else:
+        arr = np.ascontiguousarray(image)
+        h.update(f"{arr.dtype}:{arr.shape}".encode())
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+def nbytes(value):
+    """Approximate memory held by a (nested) structure of tensors / arrays / PIL images."""
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, "element_size") and hasattr(value, "numel"):
+        return value.element_size() * value.numel()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "getbands") and hasattr(value, "size"):
+        width, height = value.size
+        return width * height * len(value.getbands())
+    return 0
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache bounded by total bytes rather than entry count.
+    Entries larger than the whole budget are not stored.
+    """
+
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_MB * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = nbytes(value)
+        if size > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.size_bytes += size
+            while self.size_bytes > self.budget_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Shared by every loaded segmenter; keys are (model name, image_key(image)).
+shared_cache = EmbeddingCache()
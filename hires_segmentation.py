@@ -0,0 +1,128 @@
+"""
+High-resolution Magic Wand selections.
+
+SAM sees the whole capture resized to its 1024 px input, which blurs thin
+structures and small buildings on large screenshots. Each click therefore
+runs a coarse pass on the full image to find the object, then a second pass
+on a crop around it at native resolution, where the model's input pixels
+are much smaller. The crop box is snapped to a grid so that follow-up
+clicks usually land on the same crop and reuse its cached embedding.
+
+Selection state kept on the selection dict:
+    logits       coarse low-res logits (full image)
+    crop_box     (x0, y0, x1, y1) of the last refinement crop, or None
+    crop_logits  low-res logits of the last refinement, for that crop
+"""
+import os
+
+import cv2
+import numpy as np
+
+from mask_raster import mask_iou
+from segmenters import segment
+
+SAM_HIRES = os.environ.get("EARTH_CANVAS_SAM_HIRES", "1") != "0"
+# Context around the coarse mask, as a fraction of its longer side...
+CROP_PADDING = 0.15
+# ...but at least this many source pixels.
+CROP_MIN_CONTEXT = 32
+# Crop edges are snapped outwards to this grid.
+CROP_GRID = 64
+# Refine only when the crop is at least this much smaller than the image.
+MIN_ZOOM = 1.5
+
+
+def refine_box(mask, points, labels, image_size):
+    """
+    Grid-aligned crop around the coarse mask and the positive clicks, or
+    None when it would not be meaningfully smaller than the image.
+    """
+    width, height = image_size
+    found = cv2.findNonZero((np.asarray(mask) > 0).astype(np.uint8))
+    xs, ys = [], []
+    if found is not None:
+        x, y, w, h = cv2.boundingRect(found)
+        xs += [x, x + w]
+        ys += [y, y + h]
+    for (px, py), label in zip(points, labels):
+        if label == 1:
+            xs.append(px)
+            ys.append(py)
+    if not xs:
+        return None
+    x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+    pad = max(CROP_MIN_CONTEXT, int(CROP_PADDING * max(x1 - x0, y1 - y0)))
+    x0 = max(0, (x0 - pad) // CROP_GRID * CROP_GRID)
+    y0 = max(0, (y0 - pad) // CROP_GRID * CROP_GRID)
+    x1 = min(width, -(-(x1 + pad) // CROP_GRID) * CROP_GRID)
+    y1 = min(height, -(-(y1 + pad) // CROP_GRID) * CROP_GRID)
+    if max(width, height) < MIN_ZOOM * max(x1 - x0, y1 - y0):
+        return None
+    return (int(x0), int(y0), int(x1), int(y1))
+
+
+def _inside(points, box):
+    x0, y0, x1, y1 = box
+    return (points[:, 0] >= x0) & (points[:, 0] < x1) & (points[:, 1] >= y0) & (points[:, 1] < y1)
+
+
+def segment_selection(image, selection, points, labels):
+    """
+    Add the clicks `points` / `labels` (source pixel coordinates) to the
+    Magic Wand `selection` and return its new mask at source resolution
+    and the score of the chosen candidate. Updates the selection's logits.
+    """
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    labels = np.asarray(labels)
+    # Coarse pass: first click asks for several candidates, later clicks
+    # refine the kept low-res logits.
+    masks, scores, logits = segment(
+        image,
+        points,
+        labels,
+        mask_input=selection["logits"],
+        multimask_output=selection["logits"] is None,
+    )
+    best = int(np.argmax(scores))
+    selection["logits"] = logits[best : best + 1]
+    coarse = masks[best] > 0
+    if not SAM_HIRES:
+        return coarse, float(scores[best])
+
+    all_points = np.concatenate([np.asarray(selection["points"], dtype=np.float32).reshape(-1, 2), points])
+    all_labels = np.concatenate([np.asarray(selection["labels"], dtype=labels.dtype), labels])
+    box = refine_box(coarse, all_points, all_labels, image.size)
+    reuse = box is not None and selection.get("crop_box") == box and selection.get("crop_logits") is not None
+    if reuse and not _inside(points, box).any():
+        # The new clicks miss the crop (e.g. a negative click away from the
+        # object): refine afresh on a crop that takes in every click.
+        box = refine_box(coarse, all_points, np.ones_like(all_labels), image.size)
+        reuse = False
+    if reuse:
+        crop_points, crop_labels = points, labels
+    else:
+        crop_points, crop_labels = all_points, all_labels
+    if box is None or not _inside(crop_points, box).any():
+        # No refinement; the crop logits no longer match the selection
+        selection["crop_box"] = selection["crop_logits"] = None
+        return coarse, float(scores[best])
+
+    x0, y0, x1, y1 = box
+    crop = image.crop(box)
+    inside = _inside(crop_points, box)
+    masks, scores, logits = segment(
+        crop,
+        crop_points[inside] - np.array([x0, y0], dtype=np.float32),
+        crop_labels[inside],
+        mask_input=selection["crop_logits"] if reuse else None,
+        multimask_output=not reuse,
+    )
+    # On a fresh crop, keep the candidate that agrees best with the coarse
+    # mask rather than the highest score, which favours small parts.
+    coarse_crop = coarse[y0:y1, x0:x1]
+    fine = 0 if reuse else max(range(len(masks)), key=lambda i: mask_iou(masks[i], coarse_crop))
+    selection["crop_box"] = box
+    selection["crop_logits"] = logits[fine : fine + 1]
+    mask = np.zeros_like(coarse)
+    mask[y0:y1, x0:x1] = masks[fine] > 0
+    return mask, float(scores[fine])
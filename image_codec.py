@@ -0,0 +1,93 @@
+"""
+Encoded-image cache.
+
+Session images (uploaded capture, renders) are encoded for display,
+download and upload many times over their life. Encodings are cached per
+image object and format and dropped with the image, so an idle rerun
+encodes nothing. Images are keyed by identity: the app replaces images
+rather than modifying them in place, and any in-place edit must call
+invalidate(). Render crops (see roi.Roi) are cached with the image they
+are cut from, under their box and size, so rendering one selection again
+(another prompt or seed) does not crop and encode the capture again.
+"""
+import io
+import threading
+import weakref
+
+import tracing
+
+# Encoder settings by format name. Uploads favour speed: low-compression
+# PNG and lossless WebP are several times faster to encode than the
+# default PNG level.
+FORMATS = {
+    "png": ("PNG", {"compress_level": 1}),
+    "webp": ("WEBP", {"lossless": True, "method": 0}),
+    "jpeg": ("JPEG", {"quality": 95}),
+}
+MIME_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+# Crop encodings kept per image; the oldest is dropped first.
+MAX_CROPS = 8
+
+_lock = threading.Lock()
+# id(image) -> (weakref to image, {format or (format, crop): bytes})
+_encodings = {}
+encodes = 0
+hits = 0
+
+
+def _forget(image_id):
+    with _lock:
+        _encodings.pop(image_id, None)
+
+
+def _cached(image, key, fmt, make):
+    global encodes, hits
+    image_id = id(image)
+    with _lock:
+        entry = _encodings.get(image_id)
+        if entry is not None and entry[0]() is image and key in entry[1]:
+            hits += 1
+            # Most recently used last, for MAX_CROPS
+            data = entry[1][key] = entry[1].pop(key)
+            return data
+    source = make()
+    format_name, options = FORMATS[fmt]
+    if format_name == "JPEG" and source.mode not in ("RGB", "L"):
+        source = source.convert("RGB")
+    buf = io.BytesIO()
+    with tracing.span("image.encode", format=fmt):
+        source.save(buf, format=format_name, **options)
+    data = buf.getvalue()
+    with _lock:
+        encodes += 1
+        entry = _encodings.get(image_id)
+        if entry is None or entry[0]() is not image:
+            entry = (weakref.ref(image), {})
+            weakref.finalize(image, _forget, image_id)
+            _encodings[image_id] = entry
+        entry[1][key] = data
+        crops = [k for k in entry[1] if isinstance(k, tuple)]
+        for k in crops[: len(crops) - MAX_CROPS]:
+            del entry[1][k]
+    return data
+
+
+def encode(image, fmt="png"):
+    """Encoded bytes of a PIL image in `fmt` (see FORMATS), encoding at most once."""
+    return _cached(image, fmt, fmt, lambda: image)
+
+
+def encode_crop(image, roi, fmt="png"):
+    """Encoded bytes of roi.crop_image(image), cached with `image` for its box and size."""
+    key = (fmt, roi.box, roi.size, roi.source_size)
+    return _cached(image, key, fmt, lambda: roi.crop_image(image))
+
+
+def invalidate(image):
+    """Drop cached encodings of an image that was modified in place."""
+    _forget(id(image))
+
+
+def stats():
+    with _lock:
+        return {"images": len(_encodings), "encodes": encodes, "hits": hits}
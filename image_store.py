@@ -0,0 +1,332 @@
+"""
+Per-session image history.
+
+Each session keeps its capture and every render applied to it as an
+undo/redo history. Entries are stored encoded (lossless WebP) in a
+process-wide pool keyed by content, so a render identical to an earlier
+one, or the same capture opened in two sessions, is stored once. Only the
+current and original images are held decoded; other entries are decoded
+when undo/redo reaches them. Encoding runs on a background thread, so
+applying a render does not wait for it.
+
+Encoded bytes count against a per-session budget (SESSION_IMAGE_BUDGET)
+and a global one (IMAGE_MEMORY_BUDGET). Past either, the least recently
+used blobs are spilled to files under IMAGE_SPILL_DIR and read back when
+needed.
+"""
+import atexit
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+SESSION_IMAGE_BUDGET = int(os.environ.get("EARTH_CANVAS_SESSION_IMAGE_MB", "256")) * 2**20
+IMAGE_MEMORY_BUDGET = int(os.environ.get("EARTH_CANVAS_IMAGE_MEMORY_MB", "2048")) * 2**20
+IMAGE_SPILL_DIR = os.environ.get("EARTH_CANVAS_IMAGE_SPILL_DIR", ".image_spill")
+# Renders kept per session besides the original capture.
+HISTORY_LIMIT = 32
+# Lossless WebP at its fastest settings: about as compact as PNG, faster to encode.
+STORE_FORMAT = ("WEBP", {"lossless": True, "method": 0, "quality": 0})
+
+logger = logging.getLogger(__name__)
+
+
+class _Blob:
+    __slots__ = ("data", "path", "size", "refs")
+
+    def __init__(self, data):
+        self.data = data
+        self.path = None
+        self.size = len(data)
+        self.refs = 0
+
+
+class BlobPool:
+    """
+    Encoded images shared by all sessions, keyed by content hash and
+    reference counted. In-memory blobs are kept in LRU order; spilled ones
+    live in a per-process directory that is removed at exit.
+    """
+
+    def __init__(self, budget=IMAGE_MEMORY_BUDGET, spill_dir=IMAGE_SPILL_DIR):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self._dir = None
+        self._lock = threading.Lock()
+        # key -> _Blob, least recently used first
+        self._blobs = OrderedDict()
+        self.memory_bytes = 0
+        self.spills = 0
+        self.disk_reads = 0
+
+    def add(self, data):
+        """Store `data` (or take another reference to identical bytes) and return its key."""
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            blob = self._blobs.get(key)
+            if blob is None:
+                blob = self._blobs[key] = _Blob(data)
+                self.memory_bytes += blob.size
+            blob.refs += 1
+            self._blobs.move_to_end(key)
+            self._spill(self._blobs, self.memory_bytes - self.budget)
+        return key
+
+    def read(self, key):
+        with self._lock:
+            blob = self._blobs[key]
+            self._blobs.move_to_end(key)
+            if blob.data is not None:
+                return blob.data
+            self.disk_reads += 1
+            # Under the lock: a concurrent release() must not delete the file mid-read
+            with open(blob.path, "rb") as f:
+                return f.read()
+
+    def release(self, key):
+        with self._lock:
+            blob = self._blobs[key]
+            blob.refs -= 1
+            if blob.refs:
+                return
+            del self._blobs[key]
+            if blob.data is not None:
+                self.memory_bytes -= blob.size
+        if blob.path is not None:
+            try:
+                os.remove(blob.path)
+            except OSError:
+                pass
+
+    def memory_size(self, keys):
+        """Bytes the blobs among `keys` hold in memory."""
+        with self._lock:
+            blobs = [self._blobs.get(key) for key in keys]
+        return sum(blob.size for blob in blobs if blob is not None and blob.data is not None)
+
+    def spill(self, keys, amount):
+        """Spill in-memory blobs among `keys`, least recently used first, until `amount` bytes are freed."""
+        with self._lock:
+            self._spill(self._blobs.keys() & set(keys), amount)
+
+    def _spill(self, keys, amount):
+        if amount <= 0:
+            return
+        for key in list(self._blobs):
+            if amount <= 0:
+                break
+            blob = self._blobs[key]
+            if key not in keys or blob.data is None:
+                continue
+            if self._dir is None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self._dir = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=self.spill_dir)
+                atexit.register(shutil.rmtree, self._dir, True)
+            blob.path = os.path.join(self._dir, f"{key}.webp")
+            with open(blob.path, "wb") as f:
+                f.write(blob.data)
+            blob.data = None
+            self.memory_bytes -= blob.size
+            amount -= blob.size
+            self.spills += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "blobs": len(self._blobs),
+                "memory_bytes": self.memory_bytes,
+                "spilled": sum(1 for blob in self._blobs.values() if blob.data is None),
+                "spills": self.spills,
+                "disk_reads": self.disk_reads,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_encoder = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-store")
+
+
+def get_pool():
+    """Process-wide blob pool, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BlobPool()
+        return _pool
+
+
+def _encode(image):
+    format_name, options = STORE_FORMAT
+    buf = io.BytesIO()
+    image.save(buf, format=format_name, **options)
+    return buf.getvalue()
+
+
+def _decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+class _Entry:
+    __slots__ = ("key", "image", "dropped")
+
+    def __init__(self, image):
+        self.key = None
+        self.image = image
+        self.dropped = False
+
+
+def _release_entries(pool, entries):
+    for entry in entries:
+        entry.dropped = True
+        if entry.key is not None:
+            pool.release(entry.key)
+
+
+class ImageStore:
+    """
+    Undo/redo history of one session's images. The first entry is the
+    original capture and is never trimmed from the history.
+    """
+
+    def __init__(self, pool=None, budget=SESSION_IMAGE_BUDGET, limit=HISTORY_LIMIT):
+        self.pool = pool or get_pool()
+        self.budget = budget
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._entries = []
+        self._position = -1
+        # Release the session's blobs when Streamlit drops its session state.
+        weakref.finalize(self, _release_entries, self.pool, self._entries)
+
+    def _add(self, image):
+        entry = _Entry(image)
+        self._entries.append(entry)
+        _encoder.submit(self._store, entry)
+
+    def _store(self, entry):
+        try:
+            data = _encode(entry.image)
+        except (OSError, ValueError):
+            # The entry keeps its decoded image instead.
+            logger.warning("Could not store history image", exc_info=True)
+            return
+        key = self.pool.add(data)
+        with self._lock:
+            if entry.dropped:
+                self.pool.release(key)
+                return
+            entry.key = key
+            if not self._pinned(entry):
+                entry.image = None
+        self._enforce_budget()
+
+    def _pinned(self, entry):
+        # The current and original images stay decoded.
+        return entry is self._entries[0] or entry is self._entries[self._position]
+
+    def _drop(self, entries):
+        _release_entries(self.pool, entries)
+        for entry in entries:
+            self._entries.remove(entry)
+
+    def _unpin(self, entry):
+        if entry.key is not None and not self._pinned(entry):
+            entry.image = None
+
+    def _keys(self):
+        return {entry.key for entry in self._entries if entry.key is not None}
+
+    def _enforce_budget(self):
+        with self._lock:
+            keys = self._keys()
+        used = self.pool.memory_size(keys)
+        if used > self.budget:
+            self.pool.spill(keys, used - self.budget)
+
+    def reset(self, image):
+        """Start a new history with `image` as the original capture (None: empty)."""
+        with self._lock:
+            self._drop(list(self._entries))
+            self._position = -1
+            if image is not None:
+                self._add(image)
+                self._position = 0
+
+    def push(self, image):
+        """Make `image` the current image, discarding the redo entries."""
+        with self._lock:
+            if not self._entries:
+                raise ValueError("push() before reset(): the history has no original image")
+            previous = self._entries[self._position]
+            self._drop(self._entries[self._position + 1 :])
+            self._add(image)
+            # Oldest renders go first; the original stays
+            self._drop(self._entries[1 : max(1, len(self._entries) - self.limit)])
+            self._position = len(self._entries) - 1
+            self._unpin(previous)
+
+    def _step(self, step):
+        with self._lock:
+            position = self._position + step
+            if not 0 <= position < len(self._entries):
+                return False
+            previous = self._entries[self._position]
+            self._position = position
+            self._unpin(previous)
+            return True
+
+    def undo(self):
+        return self._step(-1)
+
+    def redo(self):
+        return self._step(1)
+
+    @property
+    def can_undo(self):
+        return self._position > 0
+
+    @property
+    def can_redo(self):
+        return 0 <= self._position < len(self._entries) - 1
+
+    def _image(self, entry):
+        with self._lock:
+            image, key = entry.image, entry.key
+        if image is not None:
+            return image
+        image = _decode(self.pool.read(key))
+        with self._lock:
+            if entry.image is None and self._pinned(entry):
+                entry.image = image
+        return image
+
+    def current(self):
+        """The current image (PIL), decoded on first access; None when empty."""
+        if not self._entries:
+            return None
+        return self._image(self._entries[self._position])
+
+    def original(self):
+        """The original capture (PIL); None when empty."""
+        if not self._entries:
+            return None
+        return self._image(self._entries[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "position": self._position,
+                "decoded": sum(1 for entry in self._entries if entry.image is not None),
+                "memory_bytes": self.pool.memory_size(self._keys()),
+            }
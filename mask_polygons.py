@@ -0,0 +1,130 @@
+"""
+Conversions between segmentation masks and the Fabric.js polygons shown
+on the selection canvas.
+
+Every polygon is sent back to the browser as canvas `initial_drawing` on
+each rerun, so contours are simplified to about one display pixel and
+converted to display space in one vectorized step.
+"""
+import json
+
+import cv2
+import numpy as np
+
+import tracing
+
+FABRIC_VERSION = "5.2.4"
+POLYGON_FILL = "rgba(255,255,6,0.6)"
+POLYGON_STROKE = "rgba(255,255,6,1.0)"
+STROKE_WIDTH = 2
+# Contours smaller than this (in source pixels) are noise.
+MIN_CONTOUR_AREA = 20
+# Maximum distance, in display pixels, between a contour and its simplification.
+SIMPLIFY_TOLERANCE = 1.0
+
+
+@tracing.timed("mask.contours")
+def mask_to_fabric(
+    mask,
+    scale_x,
+    scale_y,
+    tolerance=SIMPLIFY_TOLERANCE,
+    min_area=MIN_CONTOUR_AREA,
+    **properties,
+):
+    """
+    Convert a mask to simplified Fabric polygons in display coordinates.
+    - mask: 2D numpy array in source resolution, nonzero = selected
+    - scale_x, scale_y: display size / source size
+    - tolerance: simplification tolerance in display pixels
+    - properties: extra keys stored on every polygon (e.g. selection=3)
+    Returns: (list of Fabric polygon dicts, stats dict with contour and
+    vertex counts before / after simplification)
+    """
+    mask_u8 = (np.asarray(mask) > 0).astype(np.uint8)
+    contours, _ = cv2.findContours(mask_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Tolerance is given on screen; approxPolyDP works in source pixels.
+    epsilon = tolerance / min(scale_x, scale_y)
+    scale = np.array([scale_x, scale_y], dtype=np.float32)
+
+    objects = []
+    stats = {"contours": 0, "vertices_in": 0, "vertices_out": 0}
+    for contour in contours:
+        if cv2.contourArea(contour) < min_area:
+            continue
+        stats["vertices_in"] += len(contour)
+        approx = cv2.approxPolyDP(contour, epsilon, True).reshape(-1, 2)
+        points = np.rint(approx * scale).astype(np.int32)
+        # Rounding to display pixels can collapse neighbouring vertices.
+        points = points[np.any(points != np.roll(points, 1, axis=0), axis=1)]
+        if len(points) < 3:
+            continue
+        origin = points.min(axis=0)
+        size = points.max(axis=0) - origin
+        stats["contours"] += 1
+        stats["vertices_out"] += len(points)
+        # Fabric places the stroked bounding box at left/top, so the
+        # vertices themselves start half a stroke further in.
+        objects.append(
+            {
+                "type": "polygon",
+                "version": FABRIC_VERSION,
+                "left": int(origin[0]) - STROKE_WIDTH / 2,
+                "top": int(origin[1]) - STROKE_WIDTH / 2,
+                "width": int(size[0]),
+                "height": int(size[1]),
+                "fill": POLYGON_FILL,
+                "stroke": POLYGON_STROKE,
+                "strokeWidth": STROKE_WIDTH,
+                "points": [{"x": x, "y": y} for x, y in (points - origin).tolist()],
+                **properties,
+            }
+        )
+    return objects, stats
+
+
+def payload_size(drawing):
+    """Size in bytes of the canvas JSON sent to the browser."""
+    return len(json.dumps(drawing, separators=(",", ":")))
+
+
+def path_to_polygon(path):
+    # ratio_scale = [disp_w / orig_w, disp_h / orig_h]
+    ratio_scale = [1, 1]
+    return {
+        "type": "polygon",
+        "version": FABRIC_VERSION,
+        "originX": "center",
+        "originY": "center",
+        "left": path["left"] * ratio_scale[0],
+        "top": path["top"] * ratio_scale[1],
+        "width": path["width"] * ratio_scale[0],
+        "height": path["height"] * ratio_scale[1],
+        "fill": POLYGON_FILL,
+        "stroke": POLYGON_STROKE,
+        "strokeWidth": STROKE_WIDTH,
+        "points": [
+            {"x": point[1] * ratio_scale[0], "y": point[2] * ratio_scale[1]}
+            for point in path["path"]
+        ],
+    }
+
+
+def flatten_masks(masks):
+    """
+    Recursively flatten masks to a list of 2D numpy arrays, keeping every
+    candidate of (..., H, W) stacks rather than only the first.
+    """
+    flat = []
+    if isinstance(masks, (list, tuple)):
+        for m in masks:
+            flat.extend(flatten_masks(m))
+        return flat
+    if hasattr(masks, "cpu") and hasattr(masks, "numpy"):
+        masks = masks.cpu().numpy()
+    if isinstance(masks, np.ndarray):
+        if masks.ndim == 2:
+            flat.append(masks)
+        else:
+            flat.extend(masks.reshape(-1, *masks.shape[-2:]))
+    return flat
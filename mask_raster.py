@@ -0,0 +1,152 @@
+"""
+Render masks built from the stored selection geometry at native resolution.
+
+Selections are kept as Fabric polygons in display coordinates (what the
+canvas shows) plus, for Magic Wand selections, the SAM mask itself. The
+render mask is built from those directly instead of from the canvas
+bitmap, so it is exact at the source resolution.
+"""
+import cv2
+import numpy as np
+from shapely import STRtree
+from shapely.geometry import Point, Polygon
+from shapely.ops import unary_union
+
+import tracing
+
+# Fixed-point bits used by cv2.fillPoly for sub-pixel vertex positions.
+_SHIFT = 4
+
+
+def pack_mask(mask):
+    """Store a boolean mask at 1 bit per pixel."""
+    mask = np.asarray(mask) > 0
+    return {"bits": np.packbits(mask, axis=-1), "shape": mask.shape}
+
+
+def unpack_mask(packed):
+    height, width = packed["shape"]
+    return np.unpackbits(packed["bits"], axis=-1, count=width).view(bool).reshape(height, width)
+
+
+def mask_iou(a, b):
+    """Intersection over union of two masks (nonzero = selected); two empty masks match (1.0)."""
+    a = np.asarray(a) > 0
+    b = np.asarray(b) > 0
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
+
+def fabric_polygon_coords(obj):
+    """
+    Absolute canvas coordinates of a Fabric polygon's vertices.
+    Fabric draws `points` relative to the centre of their bounding box,
+    placed at the object's origin (left/top or centre) plus half the stroke.
+    """
+    pts = np.array([[p["x"], p["y"]] for p in obj["points"]], dtype=np.float64)
+    scale = np.array([obj.get("scaleX", 1.0), obj.get("scaleY", 1.0)])
+    mins, maxs = pts.min(axis=0), pts.max(axis=0)
+    size = (maxs - mins) * scale
+    stroke = obj.get("strokeWidth", 0)
+    center = np.array([float(obj.get("left", 0)), float(obj.get("top", 0))])
+    if obj.get("originX", "left") == "left":
+        center[0] += (size[0] + stroke) / 2
+    if obj.get("originY", "top") == "top":
+        center[1] += (size[1] + stroke) / 2
+    return center + (pts - (mins + maxs) / 2) * scale
+
+
+class SelectionGeometry:
+    """
+    Shapely view of the canvas polygons in source pixel coordinates.
+    - objects: Fabric objects from st.session_state.sam_polygons
+    - scale_x, scale_y: source size / display size
+    Objects with "op": "subtract" are cut out of the union of the others.
+    """
+
+    def __init__(self, objects, scale_x=1.0, scale_y=1.0):
+        self.objects = []
+        self.polygons = []
+        for obj in objects:
+            if obj.get("type") != "polygon" or len(obj.get("points", ())) < 3:
+                continue
+            coords = fabric_polygon_coords(obj) * (scale_x, scale_y)
+            polygon = Polygon(coords)
+            if not polygon.is_valid:
+                polygon = polygon.buffer(0)
+            if polygon.is_empty:
+                continue
+            self.objects.append(obj)
+            self.polygons.append(polygon)
+        self.tree = STRtree(self.polygons)
+
+    def _select(self, subtract):
+        return [
+            p
+            for p, obj in zip(self.polygons, self.objects)
+            if (obj.get("op") == "subtract") == subtract
+        ]
+
+    def union(self):
+        """Added area minus subtracted area, as one shapely geometry."""
+        added = unary_union(self._select(False))
+        subtracted = self._select(True)
+        if subtracted:
+            added = added.difference(unary_union(subtracted))
+        return added
+
+    def hit_test(self, x, y):
+        """Objects whose polygon contains the source-space point (x, y)."""
+        point = Point(x, y)
+        hits = self.tree.query(point, predicate="intersects")
+        return [self.objects[i] for i in sorted(hits)]
+
+    def rasterize(self, size, subtract=None, fill=255):
+        """
+        Rasterize polygons into a uint8 mask of `size` (width, height).
+        - subtract: None for union-minus-subtract, True / False for only
+          the subtracting / adding polygons
+        """
+        width, height = size
+        mask = np.zeros((height, width), dtype=np.uint8)
+        geometry = self.union() if subtract is None else unary_union(self._select(subtract))
+        for polygon in getattr(geometry, "geoms", [geometry]):
+            if polygon.is_empty or polygon.geom_type != "Polygon":
+                continue
+            cv2.fillPoly(mask, [_fixed_point(polygon.exterior.coords)], fill, cv2.LINE_8, _SHIFT)
+            holes = [_fixed_point(ring.coords) for ring in polygon.interiors]
+            if holes:
+                cv2.fillPoly(mask, holes, 0, cv2.LINE_8, _SHIFT)
+        return mask
+
+
+def _fixed_point(coords):
+    # Pixel centres are at integer coordinates for fillPoly; polygon
+    # coordinates treat pixel (0, 0) as the square [0, 1) x [0, 1).
+    pts = np.asarray(coords, dtype=np.float64) - 0.5
+    return np.rint(pts * (1 << _SHIFT)).astype(np.int32)
+
+
+@tracing.timed("mask.rasterize")
+def build_render_mask(objects, selection_masks, source_size, display_size):
+    """
+    Build the render mask at source resolution.
+    - objects: canvas Fabric objects (display coordinates)
+    - selection_masks: {selection id: packed SAM mask at source size}
+    - source_size, display_size: (width, height)
+    Selections with a stored SAM mask use it as-is; other polygons are
+    rasterized from their geometry, and subtracting polygons are cut last.
+    Returns: uint8 mask (0 / 255) of shape (height, width)
+    """
+    width, height = source_size
+    scale = (width / display_size[0], height / display_size[1])
+    drawn = [o for o in objects if o.get("selection") not in selection_masks]
+    geometry = SelectionGeometry(drawn, *scale)
+    mask = geometry.rasterize(source_size, subtract=False)
+    for selection_id in {o.get("selection") for o in objects} & set(selection_masks):
+        mask[unpack_mask(selection_masks[selection_id])] = 255
+    if any(o.get("op") == "subtract" for o in drawn):
+        mask[geometry.rasterize(source_size, subtract=True) > 0] = 0
+    return mask
@@ -1,76 +1,53 @@
 #This is an example that uses the websockets api to know when a prompt execution is done
 #Once the prompt execution is done it downloads the images using the /history endpoint
 
-import websocket #NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
 import sys
-import uuid
-import json
-import urllib.request
-import urllib.parse
 from PIL import Image
 import io
-import os
-
-server_address = "127.0.0.1:8188"
-client_id = str(uuid.uuid4())
-
-image_node_id = "18"
-mask_node_id = "11"
-prompt_node_id = "159"
-original_image_node_id = "151"
+import random
+from comfy_client import get_client, upload_name
+from workflow_template import get_template, merge_graphs
+from render_cache import get_render_cache, render_key
+from render_scheduler import RENDER_HOSTS, get_scheduler
+from submission_optimizer import ExecutionReport, prune, record
+
+#First configured host; renders are spread over all of them by the scheduler
+server_address = RENDER_HOSTS[0]
+# Largest seed the Seed (rgthree) node accepts
+SEED_MAX = 2**50
 
 def queue_prompt(prompt):
-    p = {"prompt": prompt, "client_id": client_id}
-    #print(p)
-    data = json.dumps(p).encode('utf-8')
-    req =  urllib.request.Request("http://{}/prompt".format(server_address), data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    return get_client(server_address).queue_prompt(prompt)
 
 def get_image(filename, subfolder, folder_type):
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
-        return response.read()
+    return get_client(server_address).get_image(filename, subfolder, folder_type)
 
 def get_history(prompt_id):
-    with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
-        return json.loads(response.read())
-
-def upload_image(image_bytes, filename, image_type="input"):
-    image = Image.open(image_bytes)
-    temp_path = os.path.join("/tmp", filename)
-    image.save(temp_path)
-    return temp_path
-
-
-def get_images(ws, prompt):
-    prompt_id = queue_prompt(prompt)['prompt_id']
-    output_images = {}
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'executing':
-                data = message['data']
-                if data['node'] is None and data['prompt_id'] == prompt_id:
-                    break #Execution is done
-        else:
-            # If you want to be able to decode the binary stream for latent previews, here is how you can do it:
-            # bytesIO = BytesIO(out[8:])
-            # preview_image = Image.open(bytesIO) # This is your preview in PIL image format, store it in a global
-            continue #previews are binary data
-
-    history = get_history(prompt_id)[prompt_id]
-    for node_id in history['outputs']:
-        node_output = history['outputs'][node_id]
-        images_output = []
-        if 'images' in node_output:
-            for image in node_output['images']:
-                image_data = get_image(image['filename'], image['subfolder'], image['type'])
-                images_output.append(image_data)
-        output_images[node_id] = images_output
-
-    return output_images
+    return get_client(server_address).get_history(prompt_id)
+
+def upload_image(image_bytes, image_type="input", address=None):
+    #Uploads straight from memory; the file name is derived from the content so an
+    #image the server already holds (e.g. the unchanged original) is not sent again
+    if hasattr(image_bytes, "getvalue"):
+        image_bytes = image_bytes.getvalue()
+    return get_client(address or server_address).upload_image(image_bytes, image_type)
+
+
+def get_images(prompt, on_event=None, address=None):
+    #Queues the prompt on the shared client and waits for its outputs; events for
+    #this prompt_id (progress, previews, ...) are passed to on_event. Display-only
+    #and unused nodes are stripped first, and the nodes that ran are recorded
+    prompt, pruned = prune(prompt)
+    report = ExecutionReport(prompt, pruned)
+
+    def forward(message):
+        report.on_event(message)
+        if on_event is not None:
+            on_event(message)
+
+    images = get_client(address or server_address).get_images(prompt, forward)
+    record(report)
+    return images
 
 def save_images(images, output_path="./"):
     #Commented out code to display the output images:
@@ -82,30 +59,19 @@ def save_images(images, output_path="./"):
             image = Image.open(io.BytesIO(image_data))
             image.save(output_path + filename)
 
-def run_pass(prompt_insertion, image_path, mask_path, original_image_path, workflow_path="./BuildingEdit.json"):
-    #print(workflow_path)
-    with open(workflow_path, 'r', encoding='utf-8') as file: 
-      prompt_text = file.read()
-
-    prompt = json.loads(prompt_text)
-
-  
-    #set the text prompt for our positive CLIPTextEncode
-    prompt[prompt_node_id]["inputs"]["value"] = prompt_insertion
-    #print(prompt["6"]["inputs"]["text"])
-    #set the text prompt for our positive CLIPTextEncode
-    prompt[mask_node_id]["inputs"]["image"] = mask_path
-
-    #set the text prompt for our positive CLIPTextEncode
-    prompt[image_node_id]["inputs"]["image"] = image_path
-
-    #set the text prompt for our positive CLIPTextEncode
-    prompt[original_image_node_id]["inputs"]["image"] = original_image_path
-
-    ws = websocket.WebSocket()
-    ws.connect("ws://{}/ws?clientId={}".format(server_address, client_id))
-    images = get_images(ws, prompt)
-    ws.close() # for in case this example is used in an environment where it will be repeatedly called, like in a Gradio app. otherwise, you'll randomly receive connection timeouts
+def run_pass(prompt_insertion, image_path, mask_path, original_image_path, workflow_path="./BuildingEdit.json", on_event=None, seed=None, address=None):
+    #The workflow is parsed and validated once; only the nodes bound to the
+    #prompt and image slots are copied and patched per render
+    template = get_template(workflow_path)
+    prompt = template.build(
+        prompt=prompt_insertion,
+        source_image=image_path,
+        mask_image=mask_path,
+        original_image=original_image_path,
+        seed=seed,
+    )
+
+    images = get_images(prompt, on_event, address)
     #(images)
     return images
 
@@ -114,3 +80,77 @@ def run_pass(prompt_insertion, image_path, mask_path, original_image_path, workf
 #save_images(images, sys.argv[4] or "./")
 
 
+
+def _input_names(*pngs):
+    #Upload names of the inputs, which tell the scheduler which hosts hold them
+    return [upload_name(png) for png in pngs]
+
+
+def render_images(prompt_insertion, source_png, mask_png, original_png, workflow_path="./BuildingEditFast.json", on_event=None, seed=None):
+    #Uploads the encoded inputs and runs the workflow on them. The mask goes to the
+    #input folder like the images: the workflows read it with LoadImage + ImageToMask.
+    #Renders with a fixed seed are looked up in the render cache first; seed -1
+    #(random) or None (workflow default) always renders
+    key = None
+    if seed is not None and seed >= 0:
+        key = render_key(source_png, original_png, mask_png, prompt_insertion, get_template(workflow_path).digest, seed)
+        images = get_render_cache().get(key)
+        if images is not None:
+            return images
+
+    def render_on(address):
+        source_ref = upload_image(source_png, address=address)
+        mask_ref = upload_image(mask_png, address=address)
+        original_ref = upload_image(original_png, address=address)
+        return run_pass(prompt_insertion, source_ref, mask_ref, original_ref, workflow_path, on_event, seed, address)
+
+    images = get_scheduler().run(render_on, _input_names(source_png, mask_png, original_png))
+    if key is not None and any(images.values()):
+        get_render_cache().put(key, images)
+    return images
+
+
+def render_variations(variants, source_png, mask_png, original_png, workflow_path="./BuildingEditFast.json", on_event=None):
+    #Renders several (prompt, seed) variants of one edit as a single submission. The
+    #inputs are uploaded once and the variant graphs are merged, so nodes they share
+    #(depth map, VAE encode of the original, model loading) run once on the server.
+    #Seed -1 is drawn here so that random variants still differ from each other.
+    #Returns one {node_id: [bytes]} per variant, in order
+    template = get_template(workflow_path)
+    results = [None] * len(variants)
+    keys = [None] * len(variants)
+    pending = []
+    for i, (prompt_insertion, seed) in enumerate(variants):
+        if seed is not None and seed >= 0:
+            keys[i] = render_key(source_png, original_png, mask_png, prompt_insertion, template.digest, seed)
+            results[i] = get_render_cache().get(keys[i])
+        if results[i] is None:
+            pending.append(i)
+    if not pending:
+        return results
+
+    seeds = [random.randrange(SEED_MAX) if variants[i][1] == -1 else variants[i][1] for i in pending]
+
+    def render_on(address):
+        source_ref = upload_image(source_png, address=address)
+        mask_ref = upload_image(mask_png, address=address)
+        original_ref = upload_image(original_png, address=address)
+        graphs = [
+            template.build(
+                prompt=variants[i][0],
+                source_image=source_ref,
+                mask_image=mask_ref,
+                original_image=original_ref,
+                seed=seed,
+            )
+            for i, seed in zip(pending, seeds)
+        ]
+        prompt, id_maps = merge_graphs(graphs)
+        return get_images(prompt, on_event, address), id_maps
+
+    images, id_maps = get_scheduler().run(render_on, _input_names(source_png, mask_png, original_png))
+    for i, id_map in zip(pending, id_maps):
+        results[i] = {node_id: images[merged_id] for node_id, merged_id in id_map.items() if merged_id in images}
+        if keys[i] is not None and any(results[i].values()):
+            get_render_cache().put(keys[i], results[i])
+    return results
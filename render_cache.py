@@ -0,0 +1,122 @@
+"""
+Content-addressed cache of render results.
+
+A render is identified by hashes of its source, original and mask images,
+the prompt text, the workflow file and the seed. Results are kept on disk,
+one directory per key, bounded by total size with least-recently-used
+eviction. Hits return without touching the render server.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+RENDER_CACHE_DIR = os.environ.get("EARTH_CANVAS_RENDER_CACHE_DIR", ".render_cache")
+RENDER_CACHE_MB = int(os.environ.get("EARTH_CANVAS_RENDER_CACHE_MB", "2048"))
+
+
+def render_key(source_png, original_png, mask_png, prompt_text, workflow_digest, seed):
+    h = hashlib.sha256()
+    for part in (source_png, original_png, mask_png):
+        h.update(hashlib.sha256(part).digest())
+    h.update(hashlib.sha256(prompt_text.encode("utf-8")).digest())
+    h.update(workflow_digest.encode("ascii"))
+    h.update(str(seed).encode("ascii"))
+    return h.hexdigest()
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class RenderCache:
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        entries = [
+            e for e in os.scandir(directory) if e.is_dir() and not e.name.startswith(".")
+        ]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            size = _dir_size(entry.path)
+            self._index[entry.name] = size
+            self.size_bytes += size
+
+    def get(self, key):
+        """Return {node_id: [image bytes]} for `key`, or None."""
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+        path = os.path.join(self.directory, key)
+        images = {}
+        try:
+            for name in sorted(os.listdir(path)):
+                node_id, _, _ = name.rpartition("_")
+                with open(os.path.join(path, name), "rb") as f:
+                    images.setdefault(node_id, []).append(f.read())
+            os.utime(path)
+        except OSError:
+            # Evicted or removed by another process in the meantime.
+            with self._lock:
+                self._forget(key)
+            return None
+        return images
+
+    def put(self, key, images):
+        tmp = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        size = 0
+        for node_id, node_images in images.items():
+            for i, data in enumerate(node_images):
+                with open(os.path.join(tmp, f"{node_id}_{i:04d}"), "wb") as f:
+                    f.write(data)
+                size += len(data)
+        path = os.path.join(self.directory, key)
+        with self._lock:
+            if key in self._index or size > self.max_bytes:
+                shutil.rmtree(tmp, ignore_errors=True)
+                return
+            os.replace(tmp, path)
+            self._index[key] = size
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                old = next(iter(self._index))
+                self._forget(old)
+                shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+
+    def _forget(self, key):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self.size_bytes -= size
+
+    def stats(self):
+        return {
+            "entries": len(self._index),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_render_cache():
+    """Process-wide cache in RENDER_CACHE_DIR, created on first use."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RenderCache()
+        return _default
@@ -0,0 +1,190 @@
+"""
+Background render jobs.
+
+Submitting returns a job id at once; a worker pool runs the render and
+records its progress, latest preview frame and result on the job, which the
+UI polls. Streamlit script threads are never blocked for the length of a
+diffusion run.
+"""
+import io
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import image_codec
+import tracing
+from pass_websocket import render_images, render_variations
+from roi import RENDER_ROI, ROI_MAX_SIDE, compute_roi
+from tiling import RENDER_TILES, render_tiled
+
+RENDER_WORKERS = int(os.environ.get("EARTH_CANVAS_RENDER_WORKERS", "4"))
+# Finished jobs nobody collected are dropped after this many seconds.
+JOB_TTL = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class RenderJob:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = QUEUED
+        self.progress = (0, 0)
+        self.node = None
+        self.preview = None
+        # Nodes ComfyUI ran / reused from its cache, over all prompts of the job
+        self.executed = 0
+        self.cached = 0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def on_event(self, message):
+        """Record ComfyUI events for this job's prompt (called from the worker)."""
+        kind, data = message["type"], message["data"]
+        if kind == "execution_start":
+            self.status = RUNNING
+        elif kind == "execution_cached":
+            self.cached += len(data.get("nodes") or ())
+        elif kind == "executing":
+            self.node = data.get("node")
+            if self.node is not None:
+                self.executed += 1
+        elif kind == "progress":
+            self.progress = (data["value"], data["max"])
+        elif kind == "preview":
+            self.preview = data
+
+
+_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _run(job, fn, args, kwargs):
+    job.started_at = time.time()
+    try:
+        with tracing.trace("render", job=job.id):
+            job.result = fn(*args, on_event=job.on_event, **kwargs)
+            tracing.annotate(executed=job.executed, cached=job.cached)
+        job.status = DONE
+    except Exception as e:
+        job.error = e
+        job.status = FAILED
+    finally:
+        job.finished_at = time.time()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run `fn(*args, on_event=callback, **kwargs)` on the render pool.
+    Returns: job id for get_job()
+    """
+    job = RenderJob()
+    now = time.time()
+    with _jobs_lock:
+        for job_id, old in list(_jobs.items()):
+            if old.finished and now - old.finished_at > JOB_TTL:
+                del _jobs[job_id]
+        _jobs[job.id] = job
+    _executor.submit(_run, job, fn, args, kwargs)
+    return job.id
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def pop_job(job_id):
+    with _jobs_lock:
+        return _jobs.pop(job_id, None)
+
+
+def _encode(source_image, mask, original_image, roi=None):
+    # Fast PNG through the codec cache: session images, and their crop for a
+    # given ROI, are encoded once however often they are rendered from. The
+    # mask changes with every selection and is always encoded; so are tiles
+    # (render_tiled crops them itself).
+    if roi is None:
+        return [image_codec.encode(image, "png") for image in (source_image, Image.fromarray(mask), original_image)]
+    return [
+        image_codec.encode_crop(source_image, roi, "png"),
+        image_codec.encode(Image.fromarray(roi.crop_mask(mask)), "png"),
+        image_codec.encode_crop(original_image, roi, "png"),
+    ]
+
+
+def _first_image(images):
+    for node_id in images:
+        for image_data in images[node_id]:
+            with tracing.span("render.decode"):
+                image = Image.open(io.BytesIO(image_data))
+                image.load()
+            return image
+    raise RuntimeError("Render process failed to return an image.")
+
+
+def _render(render_fn, source_image, mask, original_image):
+    """
+    Run `render_fn(source_png, mask_png, original_png)`, which returns a
+    list of {node_id: [png bytes]} (one per variant), on the part of the
+    image the mask touches: a crop around the mask (unless RENDER_ROI is
+    off), or overlapping tiles at native resolution when that region is
+    larger than ROI_MAX_SIDE.
+    Returns: list of PIL.Image at the source size, one per variant
+    """
+    roi = compute_roi(mask) if RENDER_ROI else None
+    extent = roi.box_size if roi is not None else source_image.size
+    if RENDER_TILES and max(extent) > ROI_MAX_SIDE:
+        def render_tile(*tile):
+            return [_first_image(images) for images in render_fn(*_encode(*tile))]
+
+        return render_tiled(render_tile, source_image, mask, original_image)
+    if roi is None:
+        return [_first_image(images) for images in render_fn(*_encode(source_image, mask, original_image))]
+    results = render_fn(*_encode(source_image, mask, original_image, roi))
+    return [roi.paste(source_image, _first_image(images), mask) for images in results]
+
+
+def render_design(prompt_text, source_image, mask, original_image, workflow_path, seed=None, on_event=None):
+    """
+    Render one edit.
+    - source_image, original_image: PIL.Image
+    - mask: uint8 numpy array (0 / 255) at the source image size
+    Returns: PIL.Image
+    """
+    def render_fn(source_png, mask_png, original_png):
+        return [render_images(prompt_text, source_png, mask_png, original_png, workflow_path, on_event=on_event, seed=seed)]
+
+    return _render(render_fn, source_image, mask, original_image)[0]
+
+
+def render_design_variations(variants, source_image, mask, original_image, workflow_path, on_event=None):
+    """
+    Render several (prompt, seed) variants of one edit in a single submission.
+    Returns: list of PIL.Image, one per variant
+    """
+    def render_fn(source_png, mask_png, original_png):
+        return render_variations(variants, source_png, mask_png, original_png, workflow_path, on_event=on_event)
+
+    return _render(render_fn, source_image, mask, original_image)
+
+
+def submit_render(prompt_text, source_image, mask, original_image, workflow_path, seed=None):
+    return submit(render_design, prompt_text, source_image, mask, original_image, workflow_path, seed)
+
+
+def submit_variations(variants, source_image, mask, original_image, workflow_path):
+    return submit(render_design_variations, variants, source_image, mask, original_image, workflow_path)
@@ -0,0 +1,177 @@
+"""
+Render scheduling across several ComfyUI hosts.
+
+EARTH_CANVAS_COMFYUI may list several host:port addresses separated by
+commas. Each render goes to the healthy host with the shortest queue,
+counting both the server's own queue (websocket "status" events, or /queue
+polled every QUEUE_POLL_INTERVAL) and renders this process has in flight
+there. A host that already holds the render's inputs is preferred unless
+it is more than AFFINITY_SLACK prompts busier. When a host fails mid-job
+(connection refused or dropped, timeout, 5xx), it is marked unhealthy and
+the render is retried on another one; a 4xx (bad upload or prompt) is the
+render's own error and is raised as is. The poller brings it back once it
+answers again.
+"""
+import logging
+import os
+import threading
+
+import requests
+import websocket
+
+import tracing
+from comfy_client import get_client
+
+RENDER_HOSTS = [
+    address.strip()
+    for address in os.environ.get("EARTH_CANVAS_COMFYUI", "127.0.0.1:8188").split(",")
+    if address.strip()
+]
+QUEUE_POLL_INTERVAL = 2.0
+AFFINITY_SLACK = 1
+MAX_ATTEMPTS = 3
+# Errors of the health poll that mark a host down.
+HOST_ERRORS = (requests.RequestException, OSError, TimeoutError, websocket.WebSocketException)
+
+logger = logging.getLogger(__name__)
+
+
+def host_failed(error):
+    """Whether `error` says something about the host rather than the render."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    if isinstance(error, requests.RequestException):
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return isinstance(error, (OSError, TimeoutError, websocket.WebSocketException))
+
+
+class Backend:
+    def __init__(self, address):
+        self.address = address
+        self.client = get_client(address)
+        self.inflight = 0
+        self.healthy = True
+        self.renders = 0
+        self.failures = 0
+
+    @property
+    def load(self):
+        return max(self.client.queue_remaining, self.inflight)
+
+    def holds(self, inputs):
+        return sum(1 for name in inputs if self.client.holds(name))
+
+    def stats(self):
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "queue": self.client.queue_remaining,
+            "inflight": self.inflight,
+            "renders": self.renders,
+            "failures": self.failures,
+        }
+
+
+class RenderScheduler:
+    def __init__(self, addresses, poll_interval=QUEUE_POLL_INTERVAL):
+        if not addresses:
+            raise ValueError("no render hosts configured")
+        self.backends = [Backend(address) for address in addresses]
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if len(self.backends) > 1:
+            threading.Thread(target=self._poll, name="render-scheduler", daemon=True).start()
+
+    def _poll(self):
+        while not self._closed.is_set():
+            for backend in self.backends:
+                try:
+                    backend.client.get_queue_length(timeout=self.poll_interval)
+                    backend.healthy = True
+                except HOST_ERRORS:
+                    backend.healthy = False
+            self._closed.wait(self.poll_interval)
+
+    def pick(self, inputs=(), exclude=()):
+        """
+        Reserve the backend for the next render and return it (None if
+        every backend is excluded). Unhealthy backends are only used when
+        no healthy one is left.
+        """
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            candidates = [b for b in candidates if b.healthy] or candidates
+            if not candidates:
+                return None
+
+            def cost(backend):
+                held = backend.holds(inputs)
+                # Slightly more than the slack, so a holder that is exactly
+                # AFFINITY_SLACK prompts busier still wins.
+                return (backend.load - (AFFINITY_SLACK + 0.5 if held else 0), -held, backend.renders)
+
+            backend = min(candidates, key=cost)
+            backend.inflight += 1
+            return backend
+
+    def run(self, fn, inputs=()):
+        """
+        Call `fn(address)` on the chosen host, retrying on others when the
+        host fails. `inputs` are the upload names the render needs (see
+        comfy_client.upload_name), used for host affinity.
+        """
+        tried = []
+        error = None
+        for _ in range(min(MAX_ATTEMPTS, len(self.backends))):
+            backend = self.pick(inputs, tried)
+            if backend is None:
+                break
+            try:
+                result = fn(backend.address)
+            except Exception as e:
+                if not host_failed(e):
+                    raise
+                backend.healthy = False
+                backend.failures += 1
+                tried.append(backend)
+                error = e
+                tracing.count("render_retries", host=backend.address)
+                logger.warning("Render host %s failed (%s), retrying elsewhere", backend.address, e)
+                continue
+            finally:
+                with self._lock:
+                    backend.inflight -= 1
+            backend.renders += 1
+            return result
+        raise error
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+    def close(self):
+        self._closed.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler over RENDER_HOSTS, created on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RenderScheduler(RENDER_HOSTS)
+        return _scheduler
+
+
+def configure(addresses):
+    """Replace the process-wide scheduler with one over `addresses`."""
+    global _scheduler, RENDER_HOSTS
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.close()
+        RENDER_HOSTS = list(addresses)
+        _scheduler = RenderScheduler(RENDER_HOSTS)
+        return _scheduler
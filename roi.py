@@ -0,0 +1,132 @@
+"""
+Region-of-interest stage around a render.
+
+Only the masked region plus some context is cropped, sent and diffused;
+the rendered crop is pasted back into the full image through a feathered
+alpha, so upload size, encode time and diffusion pixels follow the size of
+the edit rather than the size of the capture.
+"""
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+RENDER_ROI = os.environ.get("EARTH_CANVAS_RENDER_ROI", "1") != "0"
+# Context around the mask bounding box, as a fraction of its longer side...
+ROI_PADDING = 0.25
+# ...but at least this many source pixels.
+ROI_MIN_CONTEXT = 64
+# Crops with a longer side above this are downscaled before upload.
+ROI_MAX_SIDE = 1536
+# Width of the blend between the render and the untouched image, in source pixels.
+ROI_FEATHER = 16
+
+
+class Roi:
+    """
+    A crop box (x0, y0, x1, y1) in source pixels, the size the crop is sent
+    at, and the size of the source image.
+    """
+
+    def __init__(self, box, size, source_size):
+        self.box = box
+        self.size = size
+        self.source_size = source_size
+
+    @property
+    def box_size(self):
+        x0, y0, x1, y1 = self.box
+        return (x1 - x0, y1 - y0)
+
+    def crop_image(self, image):
+        """Crop a PIL image of the source size (or one proportional to it)."""
+        box = self.box
+        if image.size != self.source_size:
+            sx = image.width / self.source_size[0]
+            sy = image.height / self.source_size[1]
+            box = tuple(int(round(v * s)) for v, s in zip(box, (sx, sy, sx, sy)))
+        return image.resize(self.size, Image.LANCZOS, box=box)
+
+    def crop_mask(self, mask):
+        x0, y0, x1, y1 = self.box
+        crop = np.ascontiguousarray(mask[y0:y1, x0:x1])
+        if crop.shape[::-1] == self.size:
+            return crop
+        return cv2.resize(crop, self.size, interpolation=cv2.INTER_NEAREST)
+
+    def paste(self, image, rendered, mask, feather=ROI_FEATHER):
+        """
+        Blend `rendered` (the render of this crop, any size) into a copy of
+        `image`. The render is kept inside the mask, fades out over `feather`
+        pixels around it and never reaches the crop border.
+        """
+        x0, y0, x1, y1 = self.box
+        width, height = self.box_size
+        rendered = rendered.convert(image.mode).resize((width, height), Image.LANCZOS)
+        alpha = feathered_alpha(mask, self.box, feather)
+        # Fade out towards crop sides inside the image; sides on the image
+        # border have nothing to blend with.
+        edge = min(feather, width // 4, height // 4)
+        if edge > 0:
+            ramp = np.arange(1, edge + 1, dtype=np.float32) / edge
+            if y0 > 0:
+                alpha[:edge, :] *= ramp[:, None]
+            if y1 < image.height:
+                alpha[-edge:, :] *= ramp[::-1, None]
+            if x0 > 0:
+                alpha[:, :edge] *= ramp[None, :]
+            if x1 < image.width:
+                alpha[:, -edge:] *= ramp[None, ::-1]
+
+        region = np.asarray(image.crop(self.box), dtype=np.float32)
+        new = np.asarray(rendered, dtype=np.float32)
+        if region.ndim == 3:
+            alpha = alpha[..., None]
+        blended = region + (new - region) * alpha
+        result = image.copy()
+        result.paste(Image.fromarray(np.rint(blended).astype(np.uint8), image.mode), self.box[:2])
+        return result
+
+
+def feathered_alpha(mask, box, feather=ROI_FEATHER):
+    """
+    Blend weight of a render over `box` (x0, y0, x1, y1) of `mask`: 1 inside
+    the mask, fading to 0 over `feather` pixels around it. Mask pixels just
+    outside the box are taken into account, so boxes that share an edge get
+    matching weights along it.
+    Returns: float32 array of the box size
+    """
+    x0, y0, x1, y1 = box
+    if feather <= 0:
+        return (mask[y0:y1, x0:x1] > 0).astype(np.float32)
+    # Dilation by `feather` plus the blur's reach (3 sigma)
+    margin = feather + (3 * feather + 1) // 2
+    height, width = mask.shape
+    mx0, my0 = max(x0 - margin, 0), max(y0 - margin, 0)
+    mx1, my1 = min(x1 + margin, width), min(y1 + margin, height)
+    inside = (mask[my0:my1, mx0:mx1] > 0).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * feather + 1, 2 * feather + 1))
+    alpha = cv2.GaussianBlur(cv2.dilate(inside, kernel).astype(np.float32), (0, 0), feather / 2)
+    alpha = np.maximum(alpha, inside)
+    return alpha[y0 - my0 : y1 - my0, x0 - mx0 : x1 - mx0]
+
+
+def compute_roi(mask, padding=ROI_PADDING, min_context=ROI_MIN_CONTEXT, max_side=ROI_MAX_SIDE):
+    """
+    Crop box around the nonzero pixels of `mask` (2D uint8 / bool array at
+    source resolution), or None if the mask is empty.
+    """
+    mask = np.asarray(mask)
+    points = cv2.findNonZero((mask > 0).astype(np.uint8))
+    if points is None:
+        return None
+    x, y, w, h = cv2.boundingRect(points)
+    pad = max(min_context, int(padding * max(w, h)))
+    height, width = mask.shape
+    box = (max(x - pad, 0), max(y - pad, 0), min(x + w + pad, width), min(y + h + pad, height))
+    box_w, box_h = box[2] - box[0], box[3] - box[1]
+    scale = min(1.0, max_side / max(box_w, box_h))
+    # Latent sizes are multiples of 8 pixels.
+    size = (max(8, int(box_w * scale) // 8 * 8), max(8, int(box_h * scale) // 8 * 8))
+    return Roi(box, size, (width, height))
@@ -1,22 +1,252 @@
+import contextlib
+import os
+import threading
+import time
+import uuid
+import numpy as np
 import torch
-import sam2
-from sam2.build_sam import build_sam2
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-
-#checkpoint = "./checkpoints/sam2.1_hiera_tiny.pt"
-#checkpoint = "./checkpoints/sam2.1_hiera_small.pt"
-checkpoint = "./checkpoints/sam2.1_hiera_large.pt"
-#checkpoint = "./checkpoints/sam2.1_hiera_base_plus.pt"
-#model_cfg = "configs/sam2.1/sam2.1_hiera_t.yaml"
-#model_cfg = "configs/sam2.1/sam2.1_hiera_s.yaml"
-model_cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
-#model_cfg = "configs/sam2.1/sam2.1_hiera_b+.yaml"
-
-predictor = SAM2ImagePredictor(build_sam2(model_cfg, checkpoint))
-
-def sam2_predict(image, points, labels):
-    print(f"Running sam2.1 with {points} and labels {labels}")
-    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-        predictor.set_image(image)
-        masks, _, _ = predictor.predict(point_coords=points, point_labels=labels)
-        return masks
\ No newline at end of file
+import tracing
+from embedding_cache import shared_cache, image_key
+from mask_raster import mask_iou
+
+# checkpoint, model config per SAM2.1 model tier
+SAM2_TIERS = {
+    "tiny": ("./checkpoints/sam2.1_hiera_tiny.pt", "configs/sam2.1/sam2.1_hiera_t.yaml"),
+    "small": ("./checkpoints/sam2.1_hiera_small.pt", "configs/sam2.1/sam2.1_hiera_s.yaml"),
+    "base+": ("./checkpoints/sam2.1_hiera_base_plus.pt", "configs/sam2.1/sam2.1_hiera_b+.yaml"),
+    "large": ("./checkpoints/sam2.1_hiera_large.pt", "configs/sam2.1/sam2.1_hiera_l.yaml"),
+}
+SAM2_TIERS["base_plus"] = SAM2_TIERS["base+"]
+
+# CPU inference mode: "int8" dynamically quantizes the Linear layers of the
+# image encoder and mask decoder, "bf16" runs under CPU autocast (only worth
+# it on CPUs with native bf16), "fp32" is the reference model. fp32 stays
+# the default until check_cpu_accuracy() has been run on real captures.
+CPU_MODES = ("int8", "bf16", "fp32")
+SAM2_CPU_MODE = os.environ.get("EARTH_CANVAS_SAM2_CPU_MODE", "fp32")
+# Intra-op threads for CPU inference; unset keeps torch's default.
+SAM2_THREADS = int(os.environ.get("EARTH_CANVAS_SAM2_THREADS", "0"))
+
+
+def _select_device():
+    if torch.cuda.is_available():
+        return "cuda"
+    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def _quantize_cpu(model):
+    """Dynamically quantize the encoder and decoder Linear layers to int8."""
+    from torch.ao.quantization import quantize_dynamic
+
+    model.image_encoder = quantize_dynamic(model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    model.sam_mask_decoder = quantize_dynamic(model.sam_mask_decoder, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class Sam2Segmenter:
+    """
+    SAM2.1 image predictor for one model tier.
+    Image embeddings are kept in the shared embedding cache, so repeated
+    clicks on the same screenshot only run the prompt encoder and decoder.
+    """
+
+    def __init__(self, tier="large", device=None, cpu_mode=None):
+        from sam2.build_sam import build_sam2
+        from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+        if tier not in SAM2_TIERS:
+            raise ValueError(f"Unknown SAM2 tier {tier!r}, expected one of {sorted(SAM2_TIERS)}")
+        checkpoint, model_cfg = SAM2_TIERS[tier]
+        self.device = device or _select_device()
+        self.cpu_mode = (cpu_mode or SAM2_CPU_MODE) if self.device == "cpu" else None
+        if self.cpu_mode is not None and self.cpu_mode not in CPU_MODES:
+            raise ValueError(f"Unknown CPU mode {self.cpu_mode!r}, expected one of {CPU_MODES}")
+        self.name = f"sam2.1-{tier}" + (f"-cpu-{self.cpu_mode}" if self.cpu_mode else "")
+
+        if self.device == "cpu" and SAM2_THREADS > 0:
+            torch.set_num_threads(SAM2_THREADS)
+        model = build_sam2(model_cfg, checkpoint, device=self.device)
+        if self.cpu_mode == "int8":
+            model = _quantize_cpu(model)
+        self.predictor = SAM2ImagePredictor(model)
+        # set_image state lives on the predictor, so restoring an embedding
+        # and predicting from it must happen atomically.
+        self._lock = threading.Lock()
+
+    def _set_image_cached(self, image, cache_key=None):
+        predictor = self.predictor
+        key = (self.name, cache_key or image_key(image))
+        cached = shared_cache.get(key)
+        if cached is None:
+            with tracing.span("sam.set_image", model=self.name):
+                predictor.set_image(image)
+            shared_cache.put(
+                key,
+                {"features": predictor._features, "orig_hw": list(predictor._orig_hw)},
+            )
+            return
+        predictor.reset_predictor()
+        predictor._features = cached["features"]
+        predictor._orig_hw = list(cached["orig_hw"])
+        predictor._is_image_set = True
+        predictor._is_batch = False
+
+    def _autocast(self):
+        if self.device == "cuda":
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        if self.cpu_mode == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        # int8 kernels and fp32 reference run without autocast; MPS autocast
+        # is not supported by all SAM2 ops.
+        return contextlib.nullcontext()
+
+    def predict(self, image, points, labels, mask_input=None, multimask_output=True, cache_key=None):
+        """
+        Predict masks for one point prompt.
+        - mask_input: (1, 256, 256) low-res logits of a previous prediction,
+          used to refine that selection with additional clicks
+        """
+        with self._lock, torch.inference_mode(), self._autocast():
+            self._set_image_cached(image, cache_key)
+            with tracing.span("sam.predict", model=self.name):
+                return self.predictor.predict(
+                    point_coords=points,
+                    point_labels=labels,
+                    mask_input=mask_input,
+                    multimask_output=multimask_output,
+                )
+
+    def predict_batch(self, image, prompts, multimask_output=True, cache_key=None):
+        """
+        Run several independent prompts on one image with one decoder call
+        per kind of prompt (which of points / box / mask_input it has).
+        Shorter point prompts are padded with label -1 points, which SAM2's
+        prompt encoder treats as "not a point".
+        - prompts: list of dicts with "points" and "labels" and/or "box"
+          (x0, y0, x1, y1), and optional "mask_input"
+        Returns: list of (masks, scores, low_res_logits), one per prompt
+        """
+        groups = {}
+        for i, prompt in enumerate(prompts):
+            kind = (
+                len(prompt.get("points", ())) > 0,
+                prompt.get("box") is not None,
+                prompt.get("mask_input") is not None,
+            )
+            groups.setdefault(kind, []).append(i)
+        results = [None] * len(prompts)
+        with self._lock, torch.inference_mode(), self._autocast():
+            self._set_image_cached(image, cache_key)
+            for (has_points, has_box, has_mask), indices in groups.items():
+                group = [prompts[i] for i in indices]
+                coords = labels = box = mask_input = None
+                if has_points:
+                    coords, labels = _stack_points(group)
+                if has_box:
+                    box = np.stack([np.asarray(p["box"], dtype=np.float32).reshape(4) for p in group])
+                if has_mask:
+                    mask_input = np.stack([np.asarray(p["mask_input"]).reshape(1, 256, 256) for p in group])
+                with tracing.span("sam.predict", model=self.name):
+                    masks, scores, logits = self.predictor.predict(
+                        point_coords=coords,
+                        point_labels=labels,
+                        box=box,
+                        mask_input=mask_input,
+                        multimask_output=multimask_output,
+                    )
+                if len(group) == 1:
+                    masks, scores, logits = masks[None], scores[None], logits[None]
+                for j, i in enumerate(indices):
+                    results[i] = (masks[j], scores[j], logits[j])
+        return results
+
+
+def _stack_points(prompts):
+    """Pad point prompts to a common length with label -1 "not a point" entries."""
+    n_points = max(len(p["points"]) for p in prompts)
+    coords = np.zeros((len(prompts), n_points, 2), dtype=np.float32)
+    labels = np.full((len(prompts), n_points), -1, dtype=np.int32)
+    for i, prompt in enumerate(prompts):
+        coords[i, : len(prompt["points"])] = prompt["points"]
+        labels[i, : len(prompt["labels"])] = prompt["labels"]
+    return coords, labels
+
+
+def sam2_predict(image, points, labels, tier=None):
+    """
+    Predict masks for one point prompt. When EARTH_CANVAS_SAM_SERVER is set
+    this is a thin client of the shared segmentation server (sam_server.py)
+    and no model is loaded in this process.
+    """
+    from segmenters import get_segmenter, SAM_SERVER
+
+    segmenter = get_segmenter("remote") if SAM_SERVER else get_segmenter("sam2", tier)
+    masks, _, _ = segmenter.predict(image, points, labels)
+    return masks
+
+
+def check_cpu_accuracy(samples, tier="large", cpu_mode="int8", threshold=0.9):
+    """
+    Compare a CPU inference mode against the fp32 reference model.
+
+    Args:
+        samples (list): (image, points, labels) tuples to segment.
+        tier (str): SAM2 model tier.
+        cpu_mode (str): mode under test, see CPU_MODES.
+        threshold (float): minimum IoU of the best mask per sample.
+
+    Returns:
+        dict with per-sample IoU, mean timings for both modes and `passed`.
+        Every timed call gets a fresh cache key, so the timings include
+        the image encoder rather than a cached embedding.
+    """
+    reference = Sam2Segmenter(tier, device="cpu", cpu_mode="fp32")
+    candidate = Sam2Segmenter(tier, device="cpu", cpu_mode=cpu_mode)
+    ious, ref_times, cand_times = [], [], []
+    for image, points, labels in samples:
+        results = []
+        for segmenter, times in ((reference, ref_times), (candidate, cand_times)):
+            cache_key = f"cpu-check-{uuid.uuid4().hex}"
+            start = time.perf_counter()
+            masks, scores, _ = segmenter.predict(image, points, labels, cache_key=cache_key)
+            times.append(time.perf_counter() - start)
+            results.append(masks[int(np.argmax(scores))])
+        ious.append(mask_iou(*results))
+    return {
+        "tier": tier,
+        "cpu_mode": cpu_mode,
+        "threshold": threshold,
+        "iou": ious,
+        "min_iou": min(ious) if ious else None,
+        "fp32_seconds": float(np.mean(ref_times)) if ref_times else None,
+        "candidate_seconds": float(np.mean(cand_times)) if cand_times else None,
+        "passed": all(iou >= threshold for iou in ious),
+    }
+
+
+if __name__ == "__main__":
+    # python sam_runner.py image.png 420,310 [x,y ...] --tier small --threshold 0.9
+    import argparse
+    import json
+    import sys
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="Check CPU SAM2 masks against fp32.")
+    parser.add_argument("image")
+    parser.add_argument("points", nargs="+", help="positive clicks as x,y")
+    parser.add_argument("--tier", default="large", choices=sorted(SAM2_TIERS))
+    parser.add_argument("--cpu-mode", default="int8", choices=CPU_MODES)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    points = [[float(v) for v in p.split(",")] for p in args.points]
+    # one sample per click plus one with all clicks together
+    samples = [(image, [p], np.ones(1)) for p in points]
+    if len(points) > 1:
+        samples.append((image, points, np.ones(len(points))))
+    report = check_cpu_accuracy(samples, args.tier, args.cpu_mode, args.threshold)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["passed"] else 1)
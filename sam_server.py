@@ -0,0 +1,302 @@
+"""
+Shared segmentation server.
+
+One process holds the segmentation model and serves every Streamlit
+session on the box over local HTTP:
+
+    python sam_server.py --port 8765 --backend sam2 --tier large
+    EARTH_CANVAS_SAM_SERVER=127.0.0.1:8765 streamlit run app.py
+
+Endpoints:
+    PUT  /images/<key>   raw pixels (X-Image-Mode / X-Image-Size headers)
+    POST /predict        {"image": key, "multimask_output": bool,
+                          "prompts": [{"points", "labels", "mask_input"?}, ...]}
+                         -> npz with stacked masks / scores / logits,
+                            404 if the image is not held by the server
+    GET  /health         model name, cache and batching counters
+
+Prompts arriving within a short window (EARTH_CANVAS_SAM_BATCH_MS) are
+grouped by image and decoded in one batched call on a single worker
+thread, which is also the only thread touching the predictor.
+"""
+import base64
+import io
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from PIL import Image
+
+from embedding_cache import EmbeddingCache, image_key, shared_cache
+
+BATCH_WINDOW_MS = float(os.environ.get("EARTH_CANVAS_SAM_BATCH_MS", "10"))
+IMAGE_STORE_MB = int(os.environ.get("EARTH_CANVAS_SAM_IMAGE_STORE_MB", "1024"))
+
+
+def encode_prediction(results):
+    """Pack a list of (masks, scores, logits) into npz bytes."""
+    masks = np.stack([r[0] for r in results]) > 0
+    buf = io.BytesIO()
+    np.savez(
+        buf,
+        masks=np.packbits(masks, axis=-1),
+        shape=np.array(masks.shape),
+        scores=np.stack([r[1] for r in results]).astype(np.float32),
+        logits=np.stack([r[2] for r in results]).astype(np.float16),
+    )
+    return buf.getvalue()
+
+
+def encode_prompt(prompt):
+    """JSON form of a prompt dict; mask_input travels as base64 fp16."""
+    encoded = {
+        "points": np.asarray(prompt.get("points", ())).tolist(),
+        "labels": np.asarray(prompt.get("labels", ())).tolist(),
+    }
+    if prompt.get("box") is not None:
+        encoded["box"] = np.asarray(prompt["box"], dtype=np.float32).reshape(4).tolist()
+    if prompt.get("mask_input") is not None:
+        mask = np.asarray(prompt["mask_input"], dtype=np.float16).reshape(256, 256)
+        encoded["mask_input"] = base64.b64encode(mask.tobytes()).decode("ascii")
+    return encoded
+
+
+def decode_prompt(encoded):
+    prompt = {
+        "points": np.asarray(encoded["points"], dtype=np.float32).reshape(-1, 2),
+        "labels": np.asarray(encoded["labels"], dtype=np.int32),
+    }
+    if encoded.get("box") is not None:
+        prompt["box"] = np.asarray(encoded["box"], dtype=np.float32)
+    if encoded.get("mask_input"):
+        mask = np.frombuffer(base64.b64decode(encoded["mask_input"]), dtype=np.float16)
+        prompt["mask_input"] = mask.astype(np.float32).reshape(1, 256, 256)
+    return prompt
+
+
+def decode_prediction(data):
+    """Inverse of encode_prediction: list of (masks, scores, logits)."""
+    npz = np.load(io.BytesIO(data))
+    shape = tuple(npz["shape"])
+    masks = np.unpackbits(npz["masks"], axis=-1, count=shape[-1]).astype(np.float32)
+    scores = npz["scores"]
+    logits = npz["logits"].astype(np.float32)
+    return [(masks[i], scores[i], logits[i]) for i in range(shape[0])]
+
+
+class _Request:
+    __slots__ = ("key", "image", "prompts", "multimask_output", "future")
+
+    def __init__(self, key, image, prompts, multimask_output):
+        self.key = key
+        self.image = image
+        self.prompts = prompts
+        self.multimask_output = multimask_output
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    Collects prompts for `window_s` after the first one arrives, then runs
+    one predict_batch call per distinct image.
+    """
+
+    def __init__(self, segmenter, window_s=BATCH_WINDOW_MS / 1000.0):
+        self.segmenter = segmenter
+        self.window_s = window_s
+        self.batches = 0
+        self.prompts = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, image, prompts, multimask_output=True):
+        request = _Request(key, image, prompts, multimask_output)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_s
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for request in self._collect():
+                groups.setdefault((request.key, request.multimask_output), []).append(request)
+            for (key, multimask_output), requests_for_image in groups.items():
+                prompts = [p for r in requests_for_image for p in r.prompts]
+                try:
+                    results = self.segmenter.predict_batch(
+                        requests_for_image[0].image,
+                        prompts,
+                        multimask_output=multimask_output,
+                        cache_key=key,
+                    )
+                except Exception as e:
+                    for request in requests_for_image:
+                        request.future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.prompts += len(prompts)
+                offset = 0
+                for request in requests_for_image:
+                    n = len(request.prompts)
+                    request.future.set_result(results[offset : offset + n])
+                    offset += n
+
+
+class SamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, segmenter, window_s=BATCH_WINDOW_MS / 1000.0):
+        super().__init__(address, _Handler)
+        self.segmenter = segmenter
+        self.batcher = MicroBatcher(segmenter, window_s)
+        # Source images, so embeddings evicted from the cache can be rebuilt.
+        self.images = EmbeddingCache(IMAGE_STORE_MB * 1024 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": "not found"})
+        server = self.server
+        self._send(
+            200,
+            {
+                "model": server.segmenter.name,
+                "images": len(server.images),
+                "embedding_cache": shared_cache.stats(),
+                "batches": server.batcher.batches,
+                "prompts": server.batcher.prompts,
+            },
+        )
+
+    def do_PUT(self):
+        if not self.path.startswith("/images/"):
+            return self._send(404, {"error": "not found"})
+        key = self.path[len("/images/") :]
+        width, height = (int(v) for v in self.headers["X-Image-Size"].split(","))
+        image = Image.frombytes(self.headers["X-Image-Mode"], (width, height), self._body())
+        if image_key(image) != key:
+            return self._send(400, {"error": "image key does not match content"})
+        self.server.images.put(key, image)
+        self._send(201, {"image": key})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self._send(404, {"error": "not found"})
+        payload = json.loads(self._body())
+        key = payload["image"]
+        image = self.server.images.get(key)
+        if image is None:
+            return self._send(404, {"error": "unknown image", "image": key})
+        prompts = [decode_prompt(p) for p in payload["prompts"]]
+        multimask_output = payload.get("multimask_output", True)
+        try:
+            results = self.server.batcher.submit(key, image, prompts, multimask_output).result()
+        except Exception as e:
+            return self._send(500, {"error": str(e)})
+        self._send(200, encode_prediction(results), "application/octet-stream")
+
+
+class RemoteSegmenter:
+    """Client for SamServer with the same predict / predict_batch interface as local segmenters."""
+
+    def __init__(self, address, timeout=60):
+        self.name = f"remote-{address}"
+        self.base_url = f"http://{address}"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _upload(self, image, key):
+        response = self._session.put(
+            f"{self.base_url}/images/{key}",
+            data=image.tobytes(),
+            headers={"X-Image-Mode": image.mode, "X-Image-Size": "%d,%d" % image.size},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+    def predict_batch(self, image, prompts, multimask_output=True, cache_key=None):
+        # The server checks uploads against image_key() of the image it
+        # receives, so the key is always computed from that PIL image;
+        # cache_key, a local alias, cannot be verified there and is ignored.
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(np.asarray(image))
+        key = image_key(image)
+        payload = {
+            "image": key,
+            "multimask_output": multimask_output,
+            "prompts": [encode_prompt(p) for p in prompts],
+        }
+        url = f"{self.base_url}/predict"
+        response = self._session.post(url, json=payload, timeout=self.timeout)
+        if response.status_code == 404:
+            self._upload(image, key)
+            response = self._session.post(url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return decode_prediction(response.content)
+
+    def predict(self, image, points, labels, mask_input=None, multimask_output=True, cache_key=None):
+        prompt = {"points": points, "labels": labels, "mask_input": mask_input}
+        return self.predict_batch(image, [prompt], multimask_output, cache_key)[0]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from segmenters import get_segmenter
+
+    parser = argparse.ArgumentParser(description="Shared segmentation server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--backend", default="sam2", choices=["sam2", "hf-sam"])
+    parser.add_argument("--tier", default=None)
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW_MS)
+    args = parser.parse_args()
+
+    segmenter = get_segmenter(args.backend, args.tier)
+    server = SamServer((args.host, args.port), segmenter, args.batch_window_ms / 1000.0)
+    print(f"Serving {segmenter.name} on http://{args.host}:{args.port}")
+    server.serve_forever()
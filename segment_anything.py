@@ -1,8 +1,10 @@
+import threading
 import torch
 from PIL import Image
 import requests
-from transformers import SamModel, SamProcessor
 import numpy as np
+import tracing
+from embedding_cache import shared_cache, image_key
 
 # Prefer CUDA if available, otherwise fall back to Apple-Silicon/Metal (MPS) when present, and finally CPU.
 if torch.cuda.is_available():
@@ -12,8 +14,87 @@ elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
 else:
     _device = "cpu"
 
-_model = SamModel.from_pretrained("facebook/sam-vit-huge").to(_device)
-_processor = SamProcessor.from_pretrained("facebook/sam-vit-huge")
+HF_SAM_TIERS = {
+    "huge": "facebook/sam-vit-huge",
+    "large": "facebook/sam-vit-large",
+    "base": "facebook/sam-vit-base",
+}
+
+
+class HFSamSegmenter:
+    """Hugging Face SAM (ViT) backend, loaded from the hub on construction."""
+
+    def __init__(self, tier="huge"):
+        from transformers import SamModel, SamProcessor
+
+        if tier not in HF_SAM_TIERS:
+            raise ValueError(f"Unknown SAM tier {tier!r}, expected one of {sorted(HF_SAM_TIERS)}")
+        self.name = f"hf-sam-{tier}"
+        self.model = SamModel.from_pretrained(HF_SAM_TIERS[tier]).to(_device)
+        self.processor = SamProcessor.from_pretrained(HF_SAM_TIERS[tier])
+        self._lock = threading.Lock()
+
+    def _prepare(self, image, input_points=None, input_labels=None, input_box=None):
+        kwargs = {}
+        if input_points is not None and len(input_points):
+            # Ensure the points are floats (necessary for torch.float32 casting)
+            kwargs["input_points"] = [[[float(x), float(y)] for x, y in input_points]]
+            if input_labels is not None:
+                kwargs["input_labels"] = [[int(l) for l in input_labels]]
+        if input_box is not None:
+            kwargs["input_boxes"] = [[[float(v) for v in np.asarray(input_box).reshape(4)]]]
+        inputs = self.processor(image, return_tensors="pt", **kwargs)
+
+        # Cast any float64 tensors to float32 to guarantee MPS compatibility
+        for k, v in list(inputs.items()):
+            if isinstance(v, torch.Tensor) and torch.is_floating_point(v) and v.dtype == torch.float64:
+                inputs[k] = v.to(dtype=torch.float32)
+
+        # Move tensors to the selected device
+        return {k: (v.to(_device) if isinstance(v, torch.Tensor) else v) for k, v in inputs.items()}
+
+    def _forward(self, image, inputs, mask_input=None, multimask_output=True, cache_key=None):
+        key = (self.name, cache_key or image_key(image))
+        with self._lock, torch.no_grad():
+            embeddings = shared_cache.get(key)
+            if embeddings is None:
+                with tracing.span("sam.set_image", model=self.name):
+                    embeddings = self.model.get_image_embeddings(inputs["pixel_values"])
+                shared_cache.put(key, embeddings)
+            model_inputs = {
+                k: v for k, v in inputs.items() if k in ("input_points", "input_labels", "input_boxes")
+            }
+            if mask_input is not None:
+                mask = torch.as_tensor(np.asarray(mask_input, dtype=np.float32).reshape(1, 1, 256, 256))
+                model_inputs["input_masks"] = mask.to(_device)
+            with tracing.span("sam.predict", model=self.name):
+                outputs = self.model(
+                    image_embeddings=embeddings, multimask_output=multimask_output, **model_inputs
+                )
+        masks = self.processor.image_processor.post_process_masks(
+            outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu()
+        )
+        return outputs, masks
+
+    def predict(self, image, points, labels, mask_input=None, multimask_output=True, cache_key=None):
+        prompt = {"points": points, "labels": labels, "mask_input": mask_input}
+        return self.predict_batch(image, [prompt], multimask_output, cache_key)[0]
+
+    def predict_batch(self, image, prompts, multimask_output=True, cache_key=None):
+        # The image embedding is shared through the cache; prompts are decoded one by one.
+        results = []
+        for p in prompts:
+            inputs = self._prepare(image, p.get("points"), p.get("labels"), p.get("box"))
+            outputs, masks = self._forward(image, inputs, p.get("mask_input"), multimask_output, cache_key)
+            results.append(
+                (
+                    masks[0][0].numpy(),
+                    outputs.iou_scores[0, 0].cpu().numpy(),
+                    outputs.pred_masks[0, 0].cpu().numpy(),
+                )
+            )
+        return results
+
 
 def segment_image(image, input_points):
     """
@@ -27,26 +108,11 @@ def segment_image(image, input_points):
         masks: Segmentation masks (list of numpy arrays)
         scores: IOU scores (torch.Tensor)
     """
-    # Ensure the points are floats (necessary for torch.float32 casting)
-    input_points = [[float(x), float(y)] for x, y in input_points]
-
-    # Prepare inputs
-    inputs = _processor(image, input_points=[input_points], return_tensors="pt")
-
-    # Cast any float64 tensors to float32 to guarantee MPS compatibility
-    for k, v in list(inputs.items()):
-        if isinstance(v, torch.Tensor) and torch.is_floating_point(v) and v.dtype == torch.float64:
-            inputs[k] = v.to(dtype=torch.float32)
-
-    # Move tensors to the selected device
-    inputs = {k: (v.to(_device) if isinstance(v, torch.Tensor) else v) for k, v in inputs.items()}
-
-    with torch.no_grad():
-        outputs = _model(**inputs)
+    from segmenters import get_segmenter
 
-    masks = _processor.image_processor.post_process_masks(
-        outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu()
-    )
+    segmenter = get_segmenter("hf-sam")
+    inputs = segmenter._prepare(image, input_points)
+    outputs, masks = segmenter._forward(image, inputs)
     scores = outputs.iou_scores.cpu()
     return masks, scores
 
@@ -0,0 +1,137 @@
+"""
+Registry of segmentation backends.
+
+Models are loaded lazily, once per (backend, tier), on the first call that
+needs them, so Streamlit workers that never segment never pay for a load.
+The backend and tier default to the EARTH_CANVAS_SEGMENTER and
+EARTH_CANVAS_SEGMENTER_TIER environment variables and can be overridden
+with configure().
+
+Every segmenter exposes:
+    predict(image, points, labels, mask_input=None, multimask_output=True)
+        -> (masks, scores, low_res_logits)
+    predict_batch(image, [{"points", "labels", "box"?, "mask_input"?}, ...], multimask_output=True)
+        -> [(masks, scores, low_res_logits), ...]
+with masks (C, H, W), scores (C,) and low_res_logits (C, 256, 256) as numpy
+arrays, one entry per candidate mask. Passing the best candidate's logits
+back as mask_input refines that selection with the new clicks only. A
+prompt may give a box (x0, y0, x1, y1) instead of or besides its points.
+"""
+import os
+import threading
+
+import numpy as np
+
+import tracing
+
+SEGMENTER_BACKEND = os.environ.get("EARTH_CANVAS_SEGMENTER", "sam2")
+SEGMENTER_TIER = os.environ.get("EARTH_CANVAS_SEGMENTER_TIER") or None
+# host:port of a shared segmentation server (sam_server.py). When set, the
+# default backend is "remote" and no model is loaded in this process.
+SAM_SERVER = os.environ.get("EARTH_CANVAS_SAM_SERVER") or None
+if SAM_SERVER and "EARTH_CANVAS_SEGMENTER" not in os.environ:
+    SEGMENTER_BACKEND = "remote"
+
+_loaders = {}
+_instances = {}
+_lock = threading.Lock()
+
+
+def register_segmenter(name, default_tier):
+    """Register `loader(tier)` as the factory for backend `name`."""
+
+    def decorator(loader):
+        _loaders[name] = (loader, default_tier)
+        return loader
+
+    return decorator
+
+
+def configure(backend=None, tier=None):
+    """Change the default backend and/or tier used by get_segmenter()."""
+    global SEGMENTER_BACKEND, SEGMENTER_TIER
+    if backend is not None:
+        if backend not in _loaders:
+            raise ValueError(f"Unknown segmenter backend: {backend}")
+        SEGMENTER_BACKEND = backend
+    if tier is not None:
+        SEGMENTER_TIER = tier
+
+
+def available_backends():
+    return sorted(_loaders)
+
+
+def get_segmenter(backend=None, tier=None):
+    """
+    Return the segmenter for `backend`/`tier`, loading it on first use.
+    Concurrent first calls block on a single load instead of racing.
+    """
+    backend = backend or SEGMENTER_BACKEND
+    if backend not in _loaders:
+        raise ValueError(f"Unknown segmenter backend: {backend}")
+    loader, default_tier = _loaders[backend]
+    if tier is None:
+        tier = SEGMENTER_TIER if backend == SEGMENTER_BACKEND and SEGMENTER_TIER else default_tier
+    key = (backend, tier)
+    segmenter = _instances.get(key)
+    if segmenter is None:
+        with _lock:
+            segmenter = _instances.get(key)
+            if segmenter is None:
+                with tracing.span("model.load", backend=backend):
+                    segmenter = loader(tier)
+                tracing.count("model_loads", backend=backend, tier=tier)
+                _instances[key] = segmenter
+    return segmenter
+
+
+def is_loaded(backend=None, tier=None):
+    backend = backend or SEGMENTER_BACKEND
+    return any(b == backend and (tier is None or t == tier) for b, t in _instances)
+
+
+def segment(image, points, labels, mask_input=None, multimask_output=True):
+    """Run the configured segmenter. See the module docstring for outputs."""
+    return get_segmenter().predict(
+        image, points, labels, mask_input=mask_input, multimask_output=multimask_output
+    )
+
+
+def segment_objects(image, objects, multimask_output=True):
+    """
+    Segment several objects of one image together; the configured backend
+    decodes them in one batched call on a single image embedding.
+    - objects: list of prompt dicts ("points"/"labels" and/or "box", optional "mask_input")
+    Returns: list of (mask, score, low_res_logits) per object, the candidate
+    with the highest predicted IoU, logits shaped (1, 256, 256) for refinement
+    """
+    results = get_segmenter().predict_batch(image, objects, multimask_output=multimask_output)
+    best = []
+    for masks, scores, logits in results:
+        i = int(np.argmax(scores))
+        best.append((masks[i], float(scores[i]), logits[i : i + 1]))
+    return best
+
+
+@register_segmenter("sam2", default_tier="large")
+def _load_sam2(tier):
+    from sam_runner import Sam2Segmenter
+
+    return Sam2Segmenter(tier)
+
+
+@register_segmenter("hf-sam", default_tier="huge")
+def _load_hf_sam(tier):
+    from segment_anything import HFSamSegmenter
+
+    return HFSamSegmenter(tier)
+
+
+@register_segmenter("remote", default_tier=None)
+def _load_remote(tier):
+    from sam_server import RemoteSegmenter
+
+    if not SAM_SERVER:
+        raise ValueError("EARTH_CANVAS_SAM_SERVER is not set")
+    return RemoteSegmenter(SAM_SERVER)
@@ -0,0 +1,157 @@
+"""
+Cache-friendly ComfyUI submissions.
+
+ComfyUI skips a node when it ran the same node with the same inputs in the
+previous prompt. Submissions are prepared so that this cache hits as often
+as possible:
+- inputs are uploaded under content-derived names (comfy_client.upload_name),
+  so an unchanged original or mask is the same file from render to render;
+- prune() strips display-only nodes (easy showAnything, PreviewImage, ...)
+  and nodes no output depends on before queueing;
+- order_for_reuse() orders a batch of renders so that consecutive prompts
+  share the expensive nodes (model loads, depth map, VAE encodes);
+  batch_render queues its jobs in this order.
+ExecutionReport collects a render's execution_cached / executing events to
+show which nodes actually ran; totals are kept for stats().
+"""
+import hashlib
+import json
+import threading
+from collections import Counter, deque
+
+from workflow_template import WorkflowError, _is_link, _topological_order
+
+# Nodes that only show values in the ComfyUI editor.
+DISPLAY_ONLY = {"easy showAnything", "PreviewImage", "ShowText|pysssss", "easy showTensorShape"}
+# Nodes whose results we download; everything else is kept only if they need it.
+OUTPUT_CLASSES = {"SaveImage"}
+# Relative cost of nodes worth keeping warm between renders.
+EXPENSIVE_NODES = {
+    "CheckpointLoaderSimple": 10,
+    "MiDaS-DepthMapPreprocessor": 5,
+    "LoraLoader": 3,
+    "ControlNetLoader": 3,
+    "VAEEncode": 1,
+    "VAEEncodeForInpaint": 1,
+}
+RECENT_REPORTS = 32
+
+
+def prune(graph, outputs=OUTPUT_CLASSES):
+    """
+    The part of `graph` the output nodes depend on, with node ids and node
+    dicts unchanged.
+    Returns: (pruned graph, number of nodes removed)
+    """
+    stack = [node_id for node_id, node in graph.items() if node["class_type"] in outputs]
+    if not stack:
+        raise WorkflowError("workflow has no output node")
+    keep = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep:
+            continue
+        keep.add(node_id)
+        for value in graph[node_id]["inputs"].values():
+            if _is_link(value) and value[0] not in keep:
+                stack.append(value[0])
+    pruned = {node_id: node for node_id, node in graph.items() if node_id in keep and node["class_type"] not in DISPLAY_ONLY}
+    return pruned, len(graph) - len(pruned)
+
+
+def node_signatures(graph):
+    """
+    Per node, a digest of its class type, literal inputs and the signatures
+    of its upstream nodes: equal signatures across prompts mean ComfyUI can
+    reuse the node's cached output.
+    """
+    signatures = {}
+    for node_id in _topological_order(graph):
+        node = graph[node_id]
+        inputs = {
+            name: [signatures[value[0]], value[1]] if _is_link(value) else value
+            for name, value in node["inputs"].items()
+        }
+        text = json.dumps([node["class_type"], inputs], sort_keys=True, default=str)
+        signatures[node_id] = hashlib.sha1(text.encode()).hexdigest()
+    return signatures
+
+
+def _reusable(graph):
+    return {
+        signature: EXPENSIVE_NODES[graph[node_id]["class_type"]]
+        for node_id, signature in node_signatures(graph).items()
+        if graph[node_id]["class_type"] in EXPENSIVE_NODES
+    }
+
+
+def order_for_reuse(graphs):
+    """
+    Order in which to queue `graphs` on one server so that each prompt
+    shares as many expensive nodes as possible with the one before it (the
+    server's cache only holds the previous prompt). Greedy, starting from
+    the first graph; ties keep the given order.
+    Returns: list of indices into `graphs`
+    """
+    if not graphs:
+        return []
+    reusable = [_reusable(graph) for graph in graphs]
+    order = [0]
+    remaining = list(range(1, len(graphs)))
+    while remaining:
+        previous = reusable[order[-1]]
+        best = max(remaining, key=lambda i: (sum(w for s, w in reusable[i].items() if s in previous), -i))
+        remaining.remove(best)
+        order.append(best)
+    return order
+
+
+class ExecutionReport:
+    """Which nodes of one submitted prompt ComfyUI ran and which it reused."""
+
+    def __init__(self, prompt, pruned=0):
+        self.prompt = prompt
+        self.pruned = pruned
+        self.prompt_id = None
+        self.cached = set()
+        self.executed = []
+
+    def on_event(self, message):
+        kind, data = message["type"], message["data"]
+        if kind == "execution_start":
+            self.prompt_id = data.get("prompt_id")
+        elif kind == "execution_cached":
+            self.cached.update(data.get("nodes") or ())
+        elif kind == "executing" and data.get("node") is not None and data["node"] not in self.executed:
+            self.executed.append(data["node"])
+
+    def summary(self):
+        return {
+            "prompt_id": self.prompt_id,
+            "nodes": len(self.prompt),
+            "pruned": self.pruned,
+            "cached": len(self.cached),
+            "executed": len(self.executed),
+            "executed_classes": dict(Counter(self.prompt[n]["class_type"] for n in self.executed if n in self.prompt)),
+        }
+
+
+_lock = threading.Lock()
+_totals = Counter()
+recent = deque(maxlen=RECENT_REPORTS)
+
+
+def record(report):
+    """Add a finished render's report to the totals and to `recent`."""
+    summary = report.summary()
+    with _lock:
+        _totals["renders"] += 1
+        for name in ("nodes", "pruned", "cached", "executed"):
+            _totals[name] += summary[name]
+        recent.append(summary)
+    return summary
+
+
+def stats():
+    with _lock:
+        return dict(_totals)
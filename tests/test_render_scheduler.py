@@ -0,0 +1,66 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import mock_comfy  # noqa: E402
+import render_scheduler  # noqa: E402
+from comfy_client import ComfyError  # noqa: E402
+from pass_websocket import render_images  # noqa: E402
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BuildingEditFast.json")
+
+
+def _png(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _inputs(seed):
+    pixels = np.random.default_rng(seed).integers(0, 255, (64, 96, 3), dtype=np.uint8)
+    mask = np.zeros((64, 96), dtype=np.uint8)
+    mask[16:32, 24:48] = 255
+    return _png(Image.fromarray(pixels)), _png(Image.fromarray(mask)), _png(Image.fromarray(pixels))
+
+
+def _hosts(first_status):
+    # The scheduler breaks ties in list order, so the first host gets the job.
+    config = dict(steps=2, step_ms=1.0, preview_every=0)
+    sick = mock_comfy.start(mock_comfy.MockConfig(prompt_status=first_status, **config))
+    healthy = mock_comfy.start(mock_comfy.MockConfig(**config))
+    scheduler = render_scheduler.configure([sick.address, healthy.address])
+    return sick, healthy, scheduler
+
+
+def test_5xx_from_prompt_fails_over_to_the_next_host():
+    sick, healthy, scheduler = _hosts(500)
+    try:
+        images = render_images("brick warehouse", *_inputs(0), WORKFLOW)
+        assert any(images.values())
+        assert healthy.stats["prompts"] == 1
+        failed, succeeded = scheduler.stats()
+        assert failed["failures"] == 1 and failed["renders"] == 0
+        assert succeeded["renders"] == 1
+    finally:
+        scheduler.close()
+        sick.kill()
+        healthy.kill()
+
+
+def test_4xx_from_prompt_is_raised_without_retry():
+    rejecting, healthy, scheduler = _hosts(400)
+    try:
+        with pytest.raises(ComfyError):
+            render_images("brick warehouse", *_inputs(1), WORKFLOW)
+        assert healthy.stats["prompts"] == 0
+        assert scheduler.stats()[0]["failures"] == 0
+    finally:
+        scheduler.close()
+        rejecting.kill()
+        healthy.kill()
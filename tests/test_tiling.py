@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from tiling import render_tiled
+
+
+def _capture(height=2500, width=3000):
+    pixels = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return pixels, Image.fromarray(pixels)
+
+
+def _solid(color, variants=1):
+    def render_fn(source_crop, mask_crop, original_crop):
+        return [Image.new("RGB", source_crop.size, color) for _ in range(variants)]
+
+    return render_fn
+
+
+def test_constant_render_is_exact_across_overlaps():
+    pixels, image = _capture()
+    mask = np.full(pixels.shape[:2], 255, dtype=np.uint8)
+    result = np.asarray(render_tiled(_solid((128, 128, 128)), image, mask, image)[0])
+    assert result.min() == result.max() == 128
+
+
+def test_pixels_outside_the_mask_keep_the_source():
+    pixels, image = _capture()
+    mask = np.zeros(pixels.shape[:2], dtype=np.uint8)
+    mask[500:2000, 600:700] = 255
+    mask[1800:1900, 600:2600] = 255
+    results = render_tiled(_solid((255, 255, 255), variants=2), image, mask, image)
+    assert len(results) == 2
+    # Well beyond the feather around the mask
+    far = cv2.dilate(mask, np.ones((81, 81), np.uint8)) == 0
+    for result in results:
+        result = np.asarray(result)
+        assert np.array_equal(result[far], pixels[far])
+        assert (result[mask > 0] == 255).all()
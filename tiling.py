@@ -0,0 +1,181 @@
+"""
+Tiled rendering of large captures.
+
+The image is cut into overlapping tiles of TILE_SIZE source pixels; only
+tiles containing masked pixels are rendered, concurrently, each at native
+resolution. Results are blended into a copy of the source with weights
+that ramp across the overlaps and follow the feathered mask, so pixels
+outside the selection keep the source. Blends are summed in float32 per
+cell of the tile grid and written out once every tile covering the cell
+has arrived, so besides the output client memory is bounded by the tiles
+still waiting on a neighbour.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import tracing
+from roi import ROI_FEATHER, Roi, feathered_alpha
+
+RENDER_TILES = os.environ.get("EARTH_CANVAS_RENDER_TILES", "1") != "0"
+TILE_SIZE = int(os.environ.get("EARTH_CANVAS_RENDER_TILE_SIZE", "1024"))
+TILE_OVERLAP = 128
+TILE_WORKERS = int(os.environ.get("EARTH_CANVAS_RENDER_TILE_WORKERS", "4"))
+
+
+def tile_starts(length, tile_size, overlap):
+    """Tile offsets covering [0, length), the last one flush with the end."""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+def plan_tiles(mask, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Boxes (x0, y0, x1, y1) of the tiles that contain masked pixels."""
+    mask = np.asarray(mask)
+    height, width = mask.shape
+    # Summed-area table: masked pixel count of any box in O(1).
+    counts = cv2.integral((mask > 0).astype(np.uint8))
+    boxes = []
+    for y0 in tile_starts(height, tile_size, overlap):
+        y1 = min(y0 + tile_size, height)
+        for x0 in tile_starts(width, tile_size, overlap):
+            x1 = min(x0 + tile_size, width)
+            if counts[y1, x1] - counts[y0, x1] - counts[y1, x0] + counts[y0, x0] > 0:
+                boxes.append((x0, y0, x1, y1))
+    return boxes
+
+
+def tile_weights(box, image_size, overlap=TILE_OVERLAP):
+    """Blend weights of a tile: 1 inside, ramping to 0 across overlaps with neighbours."""
+    x0, y0, x1, y1 = box
+    width, height = image_size
+    wx = np.ones(x1 - x0, dtype=np.float32)
+    wy = np.ones(y1 - y0, dtype=np.float32)
+    ramp = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+    for weights, start, end, limit in ((wx, x0, x1, width), (wy, y0, y1, height)):
+        n = min(overlap, len(weights))
+        if start > 0:
+            weights[:n] = ramp[:n]
+        if end < limit:
+            weights[len(weights) - n:] = np.minimum(weights[len(weights) - n:], ramp[:n][::-1])
+    return wy[:, None] * wx[None, :]
+
+
+def _normalized_weights(box, boxes, image_size, overlap):
+    """A tile's blend weights divided by the summed weights of all tiles (where above 1)."""
+    x0, y0, x1, y1 = box
+    weights = tile_weights(box, image_size, overlap)
+    total = np.zeros_like(weights)
+    for other in boxes:
+        ix0, iy0 = max(x0, other[0]), max(y0, other[1])
+        ix1, iy1 = min(x1, other[2]), min(y1, other[3])
+        if ix0 >= ix1 or iy0 >= iy1:
+            continue
+        other_weights = tile_weights(other, image_size, overlap)
+        total[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] += other_weights[
+            iy0 - other[1]:iy1 - other[1], ix0 - other[0]:ix1 - other[0]
+        ]
+    return weights / np.maximum(total, 1.0)
+
+
+def _grid_cells(boxes):
+    """
+    Cut the union of `boxes` along every tile edge.
+    Returns: {cell box: number of boxes covering it}, and per box its cells
+    """
+    xs = sorted({v for box in boxes for v in (box[0], box[2])})
+    ys = sorted({v for box in boxes for v in (box[1], box[3])})
+    coverage = {}
+    cells = {}
+    for box in boxes:
+        x0, y0, x1, y1 = box
+        cells[box] = [
+            (cx0, cy0, cx1, cy1)
+            for cy0, cy1 in zip(ys, ys[1:])
+            if y0 <= cy0 and cy1 <= y1
+            for cx0, cx1 in zip(xs, xs[1:])
+            if x0 <= cx0 and cx1 <= x1
+        ]
+        for cell in cells[box]:
+            coverage[cell] = coverage.get(cell, 0) + 1
+    return coverage, cells
+
+
+def render_tiled(
+    render_fn,
+    source_image,
+    mask,
+    original_image,
+    tile_size=TILE_SIZE,
+    overlap=TILE_OVERLAP,
+    workers=TILE_WORKERS,
+    feather=ROI_FEATHER,
+):
+    """
+    Render the masked tiles of a large image and blend them into it.
+    - render_fn(source_crop, mask_crop, original_crop): returns a list of
+      rendered PIL images for that tile (one per variant)
+    - source_image, original_image: PIL.Image; mask: uint8 array (0 / 255)
+    Returns: list of full-size PIL.Image, one per variant
+    """
+    boxes = plan_tiles(mask, tile_size, overlap)
+    if not boxes:
+        raise ValueError("mask is empty")
+    size = source_image.size
+    source = np.asarray(source_image)
+    coverage, cells = _grid_cells(boxes)
+    results = []
+    # cell -> float32 sums of weight * (render - source), one per variant,
+    # while some tile covering the cell has not arrived yet
+    pending = {}
+    arrived = {}
+
+    def run(box):
+        tile = Roi(box, (box[2] - box[0], box[3] - box[1]), size)
+        x0, y0, x1, y1 = box
+        return render_fn(tile.crop_image(source_image), mask[y0:y1, x0:x1], tile.crop_image(original_image))
+
+    # Each tile adds weight * (render - source) to its cells as it finishes;
+    # where the weights sum below 1 (outer overlaps, around the mask) the
+    # source shows through. Cells are rounded once, when complete, so
+    # overlaps do not collect one rounding error per tile.
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile") as pool:
+        futures = {pool.submit(tracing.bind(run), box): box for box in boxes}
+        for future in as_completed(futures):
+            x0, y0, x1, y1 = box = futures[future]
+            weights = _normalized_weights(box, boxes, size, overlap) * feathered_alpha(mask, box, feather)
+            if source.ndim == 3:
+                weights = weights[..., None]
+            deltas = []
+            for rendered in future.result():
+                rendered = rendered.convert(source_image.mode)
+                if rendered.size != (x1 - x0, y1 - y0):
+                    rendered = rendered.resize((x1 - x0, y1 - y0), Image.LANCZOS)
+                deltas.append((np.asarray(rendered, dtype=np.float32) - source[y0:y1, x0:x1]) * weights)
+            while len(results) < len(deltas):
+                results.append(source.copy())
+            for cell in cells[box]:
+                cx0, cy0, cx1, cy1 = cell
+                part = [delta[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0] for delta in deltas]
+                sums = pending.get(cell)
+                if sums is None:
+                    sums = [p.copy() for p in part]
+                else:
+                    for total, p in zip(sums, part):
+                        total += p
+                arrived[cell] = arrived.get(cell, 0) + 1
+                if arrived[cell] < coverage[cell]:
+                    pending[cell] = sums
+                    continue
+                pending.pop(cell, None)
+                for pixels, total in zip(results, sums):
+                    region = pixels[cy0:cy1, cx0:cx1]
+                    region[...] = np.clip(np.rint(region + total), 0, 255).astype(np.uint8)
+    return [Image.fromarray(pixels, source_image.mode) for pixels in results]
@@ -0,0 +1,309 @@
+"""
+Latency tracing and metrics.
+
+Stages of the segmentation and render paths are timed with named spans:
+
+    with tracing.span("sam.predict"):
+        ...
+
+    @tracing.timed("mask.contours")
+    def mask_to_fabric(...):
+        ...
+
+Durations feed one Prometheus histogram over all stages
+(earth_canvas_stage_seconds{stage=...}), and count() adds to counters
+(earth_canvas_<name>_total). Cache hits and misses, upload skips and
+ComfyUI node counts are read from the modules' own stats() when metrics
+are exported, so those paths pay nothing. Inside a trace() block the spans
+of one request, and attributes added with annotate(), are also collected
+and, with EARTH_CANVAS_TRACE_LOG set, appended there as one JSON line.
+
+Everything is off unless enabled (EARTH_CANVAS_METRICS=1, or any exporter
+configured): span() then returns a shared no-op context manager and timed()
+returns the function unchanged. Exporters, started by start_exporters():
+    EARTH_CANVAS_METRICS_PORT   serve GET /metrics on this port
+    EARTH_CANVAS_METRICS_FILE   rewrite this file every METRICS_INTERVAL seconds
+    EARTH_CANVAS_TRACE_LOG      append per-request traces (JSONL)
+"""
+import atexit
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("EARTH_CANVAS_METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("EARTH_CANVAS_METRICS_FILE") or None
+TRACE_LOG = os.environ.get("EARTH_CANVAS_TRACE_LOG") or None
+ENABLED = os.environ.get("EARTH_CANVAS_METRICS") == "1" or bool(METRICS_PORT or METRICS_FILE or TRACE_LOG)
+METRICS_INTERVAL = 15
+PREFIX = "earth_canvas"
+# Histogram bucket bounds in seconds, from a mask rasterization to a slow render.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+# (stage, labels) -> [count per bucket..., count above the last, sum]
+_histograms = {}
+# (name, labels) -> value
+_counters = {}
+_trace = contextvars.ContextVar("earth_canvas_trace", default=None)
+_NO_SPAN = contextlib.nullcontext()
+
+logger = logging.getLogger(__name__)
+
+
+def _key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(stage, seconds, **labels):
+    """Record a duration measured elsewhere (e.g. between two ComfyUI events)."""
+    if not ENABLED:
+        return
+    key = (stage, _key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+    trace = _trace.get()
+    if trace is not None:
+        trace["spans"].append(
+            {
+                "stage": stage,
+                "start_s": round(time.perf_counter() - seconds - trace["_t0"], 6),
+                "duration_s": round(seconds, 6),
+                **labels,
+            }
+        )
+
+
+def count(name, n=1, **labels):
+    """Add `n` to the counter earth_canvas_<name>_total."""
+    if not ENABLED:
+        return
+    key = (name, _key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+@contextlib.contextmanager
+def _span(stage, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def span(stage, **labels):
+    """Context manager timing one stage."""
+    if not ENABLED:
+        return _NO_SPAN
+    return _span(stage, labels)
+
+
+def timed(stage):
+    """Decorator timing every call of a function as `stage`."""
+
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _span(stage, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+@contextlib.contextmanager
+def _trace_block(name, attributes):
+    record = {
+        "trace": name,
+        "id": uuid.uuid4().hex[:16],
+        "start": round(time.time(), 3),
+        **attributes,
+        "spans": [],
+        "_t0": time.perf_counter(),
+    }
+    token = _trace.set(record)
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _trace.reset(token)
+        elapsed = time.perf_counter() - record.pop("_t0")
+        record["duration_s"] = round(elapsed, 6)
+        observe(f"{name}.total", elapsed)
+        if TRACE_LOG:
+            line = json.dumps(record, default=str) + "\n"
+            with _lock:
+                with open(TRACE_LOG, "a") as f:
+                    f.write(line)
+
+
+def trace(name, **attributes):
+    """Collect the spans of one request (a render, a Magic Wand click) into one trace."""
+    if not ENABLED:
+        return _NO_SPAN
+    return _trace_block(name, attributes)
+
+
+def annotate(**attributes):
+    """Add attributes (counts, sizes) to the current trace's record, if any."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.update(attributes)
+
+
+def bind(fn):
+    """`fn` running inside the current trace, for handing work to another thread."""
+    if _trace.get() is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def _collect():
+    """Counters and gauges kept by other modules, read only from modules already loaded."""
+    hits, misses, collected = [], [], []
+    modules = sys.modules
+    if "embedding_cache" in modules:
+        stats = modules["embedding_cache"].shared_cache.stats()
+        hits.append(({"cache": "embedding"}, stats["hits"]))
+        misses.append(({"cache": "embedding"}, stats["misses"]))
+    if "render_cache" in modules and modules["render_cache"]._default is not None:
+        stats = modules["render_cache"]._default.stats()
+        hits.append(({"cache": "render"}, stats["hits"]))
+        misses.append(({"cache": "render"}, stats["misses"]))
+    if "image_codec" in modules:
+        stats = modules["image_codec"].stats()
+        hits.append(({"cache": "encoding"}, stats["hits"]))
+        misses.append(({"cache": "encoding"}, stats["encodes"]))
+    if "comfy_client" in modules:
+        for address, client in list(modules["comfy_client"]._clients.items()):
+            hits.append(({"cache": "upload", "host": address}, client.upload_skips))
+            misses.append(({"cache": "upload", "host": address}, client.uploads))
+            collected.append(("comfy_reconnects_total", "counter", {"host": address}, client.reconnects))
+            collected.append(("comfy_queue_remaining", "gauge", {"host": address}, client.queue_remaining))
+    if "submission_optimizer" in modules:
+        stats = modules["submission_optimizer"].stats()
+        for state in ("executed", "cached", "pruned"):
+            collected.append(("comfy_nodes_total", "counter", {"state": state}, stats.get(state, 0)))
+    if "image_store" in modules and modules["image_store"]._pool is not None:
+        stats = modules["image_store"]._pool.stats()
+        collected.append(("image_store_memory_bytes", "gauge", {}, stats["memory_bytes"]))
+        collected.append(("image_store_spills_total", "counter", {}, stats["spills"]))
+    if "segmenters" in modules:
+        collected.append(("models_loaded", "gauge", {}, len(modules["segmenters"]._instances)))
+    collected += [("cache_hits_total", "counter", labels, value) for labels, value in hits]
+    collected += [("cache_misses_total", "counter", labels, value) for labels, value in misses]
+    return collected
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+    families = {}
+    for name, kind, labels, value in _collect():
+        families.setdefault((f"{PREFIX}_{name}", kind), []).append((labels, value))
+    for (name, labels), value in counters.items():
+        families.setdefault((f"{PREFIX}_{name}_total", "counter"), []).append((dict(labels), value))
+
+    lines = []
+    name = f"{PREFIX}_stage_seconds"
+    lines.append(f"# TYPE {name} histogram")
+    for (stage, labels), values in sorted(histograms.items()):
+        base = {"stage": stage, **dict(labels)}
+        cumulative = 0
+        for bound, n in zip(BUCKETS, values):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels_text({**base, 'le': repr(float(bound))})} {cumulative}")
+        total = cumulative + values[len(BUCKETS)]
+        lines.append(f"{name}_bucket{_labels_text({**base, 'le': '+Inf'})} {total}")
+        lines.append(f"{name}_sum{_labels_text(base)} {values[-1]}")
+        lines.append(f"{name}_count{_labels_text(base)} {total}")
+    for (name, kind), samples in sorted(families.items()):
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels_text(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_metrics(path=None):
+    """Write the metrics to `path` (default METRICS_FILE) atomically."""
+    path = path or METRICS_FILE
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render_metrics())
+    os.replace(tmp, path)
+
+
+def _write_loop():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        try:
+            write_metrics()
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %s", METRICS_FILE, e)
+
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def start_exporters():
+    """Start the configured exporters once per process."""
+    global _started
+    with _started_lock:
+        if _started or not ENABLED:
+            return
+        _started = True
+    if METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), _MetricsHandler)
+        except OSError as e:
+            logger.warning("Metrics endpoint not started on port %s: %s", METRICS_PORT, e)
+        else:
+            threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    if METRICS_FILE:
+        threading.Thread(target=_write_loop, name="metrics-file", daemon=True).start()
+        atexit.register(write_metrics)
@@ -0,0 +1,213 @@
+"""
+Compiled ComfyUI workflow templates.
+
+Each workflow JSON (API format) is parsed and validated once. Named input
+slots ("prompt", "source_image", ...) are bound to node ids by class type
+and title, and submissions are produced by copy-on-write patching: only the
+patched nodes are copied, every other node is shared with the template, so
+treat built graphs as read-only. Templates are reloaded when their file
+changes, checked at most every RELOAD_INTERVAL seconds.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+RELOAD_INTERVAL = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+class WorkflowError(ValueError):
+    pass
+
+
+class SlotSpec:
+    """
+    Where a named input lives: the `input` of the node with `class_type`
+    (and `title`, when given). `hint` is the node id used in our workflows,
+    which breaks ties when several nodes match.
+    """
+
+    def __init__(self, class_type, title, input, hint=None):
+        self.class_type = class_type
+        self.title = title
+        self.input = input
+        self.hint = hint
+
+
+SLOTS = {
+    "source_image": SlotSpec("LoadImage", "Load Image", "image", hint="18"),
+    "mask_image": SlotSpec("LoadImage", "Load Mask", "image", hint="11"),
+    "original_image": SlotSpec("LoadImage", "Load Original Image", "image", hint="151"),
+    "prompt": SlotSpec("PrimitiveStringMultiline", "String (Multiline)", "value", hint="159"),
+    "seed": SlotSpec("Seed (rgthree)", None, "seed", hint="138"),
+}
+
+
+def validate_graph(graph):
+    """Check the API-format structure and that every link points at a node."""
+    if not isinstance(graph, dict) or not graph:
+        raise WorkflowError("workflow must be a non-empty object of nodes")
+    for node_id, node in graph.items():
+        if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+            raise WorkflowError(f"node {node_id} is not an API-format node")
+        for name, value in node["inputs"].items():
+            if _is_link(value):
+                if value[0] not in graph:
+                    raise WorkflowError(f"node {node_id} input {name!r} links to missing node {value[0]}")
+
+
+def _is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+def _topological_order(graph):
+    order = []
+    state = {}
+    for root in graph:
+        stack = [(root, False)]
+        while stack:
+            node_id, expanded = stack.pop()
+            if expanded:
+                state[node_id] = "done"
+                order.append(node_id)
+                continue
+            if state.get(node_id) is not None:
+                if state[node_id] == "open":
+                    raise WorkflowError(f"workflow has a cycle through node {node_id}")
+                continue
+            state[node_id] = "open"
+            stack.append((node_id, True))
+            for value in graph[node_id]["inputs"].values():
+                if _is_link(value) and state.get(value[0]) != "done":
+                    stack.append((value[0], False))
+    return order
+
+
+def merge_graphs(graphs):
+    """
+    Merge several submission graphs into one so that work they share runs
+    once. Nodes are hash-consed in dependency order: a node is shared when
+    its class type, literal inputs and (already merged) upstream nodes are
+    identical. Shared nodes keep their id; the rest of graph i get "v<i>:".
+    Returns: (merged graph, one {node id in graph i: merged node id} per graph)
+    """
+    merged = {}
+    by_signature = {}
+    id_maps = []
+    for index, graph in enumerate(graphs):
+        id_map = {}
+        for node_id in _topological_order(graph):
+            node = graph[node_id]
+            inputs = {
+                name: [id_map[value[0]], value[1]] if _is_link(value) else value
+                for name, value in node["inputs"].items()
+            }
+            signature = json.dumps([node["class_type"], inputs], sort_keys=True)
+            merged_id = by_signature.get(signature)
+            if merged_id is None:
+                merged_id = node_id if node_id not in merged else f"v{index}:{node_id}"
+                merged[merged_id] = {**node, "inputs": inputs}
+                by_signature[signature] = merged_id
+            id_map[node_id] = merged_id
+        id_maps.append(id_map)
+    return merged, id_maps
+
+
+def bind_slots(graph, slots=SLOTS):
+    """Resolve slot names to (node id, input name) for the slots present in `graph`."""
+    bindings = {}
+    for name, spec in slots.items():
+        candidates = [
+            node_id
+            for node_id, node in graph.items()
+            if node["class_type"] == spec.class_type
+            and (spec.title is None or node.get("_meta", {}).get("title") == spec.title)
+        ]
+        if not candidates:
+            continue
+        if len(candidates) == 1:
+            node_id = candidates[0]
+        elif spec.hint in candidates:
+            node_id = spec.hint
+        else:
+            raise WorkflowError(f"slot {name!r} is ambiguous: nodes {', '.join(candidates)} all match")
+        bindings[name] = (node_id, spec.input)
+    return bindings
+
+
+class WorkflowTemplate:
+    def __init__(self, path, slots=SLOTS):
+        self.path = os.path.abspath(path)
+        self.slots = slots
+        self._load()
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            raw = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+        try:
+            graph = json.loads(raw)
+        except ValueError as e:
+            raise WorkflowError(f"{self.path} is not valid JSON: {e}") from e
+        validate_graph(graph)
+        self.bindings = bind_slots(graph, self.slots)
+        self.graph = graph
+        self.digest = hashlib.sha256(raw).hexdigest()
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+    def maybe_reload(self):
+        """Reload if the file changed; keeps the previous graph if the new one is invalid."""
+        if time.monotonic() - self.checked_at < RELOAD_INTERVAL:
+            return False
+        self.checked_at = time.monotonic()
+        try:
+            if os.stat(self.path).st_mtime_ns == self.mtime:
+                return False
+            self._load()
+        except (OSError, WorkflowError) as e:
+            logger.warning("Keeping previous %s: %s", os.path.basename(self.path), e)
+            return False
+        return True
+
+    def has_slot(self, name):
+        return name in self.bindings
+
+    def build(self, **values):
+        """
+        Return a submission graph with the given slots set. None values
+        leave the template's value in place.
+        """
+        prompt = dict(self.graph)
+        for name, value in values.items():
+            if value is None:
+                continue
+            if name not in self.bindings:
+                raise WorkflowError(f"{os.path.basename(self.path)} has no {name!r} slot")
+            node_id, input_name = self.bindings[name]
+            node = dict(prompt[node_id])
+            node["inputs"] = {**node["inputs"], input_name: value}
+            prompt[node_id] = node
+        return prompt
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(path):
+    """Compiled template for `path`, loaded on first use and hot-reloaded on change."""
+    path = os.path.abspath(path)
+    template = _templates.get(path)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(path)
+            if template is None:
+                template = _templates[path] = WorkflowTemplate(path)
+        return template
+    template.maybe_reload()
+    return template